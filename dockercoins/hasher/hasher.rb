@@ -11,6 +11,18 @@ post '/' do
     "#{Digest::SHA2.new().update(request.body.read)}"
 end
 
+# Hash a batch of blocks of block_size bytes, one hash per line
+post '/batch/:block_size' do
+    block_size = params['block_size'].to_i
+    halt 400, "block_size should be a positive integer\n" if block_size <= 0
+    sleep 0.1
+    content_type 'text/plain'
+    data = request.body.read
+    (0...data.bytesize).step(block_size).map { |i|
+        Digest::SHA2.new().update(data.byteslice(i, block_size)).to_s
+    }.join("\n")
+end
+
 get '/' do
     "HASHER running on #{Socket.gethostname}\n"
 end
@@ -1,4 +1,4 @@
-from flask import Flask, Response
+from flask import Flask, Response, abort
 import os
 import socket
 import time
@@ -12,6 +12,9 @@ hostname = socket.gethostname()
 
 urandom = os.open("/dev/urandom", os.O_RDONLY)
 
+# Maximum size of a batch (block_size * count), in bytes
+MAX_BATCH_BYTES = 1024 * 1024
+
 
 @app.route("/")
 def index():
@@ -27,6 +30,21 @@ def rng(how_many_bytes):
         content_type="application/octet-stream")
 
 
+@app.route("/batch/<int:block_size>/<int:count>")
+def rng_batch(block_size, count):
+    # Same as above, but for count blocks at once (with a single delay)
+    how_many_bytes = block_size * count
+    if not 0 < how_many_bytes <= MAX_BATCH_BYTES:
+        abort(400, "block_size * count should be between 1 and {}"
+                   .format(MAX_BATCH_BYTES))
+    time.sleep(0.1)
+    # Large reads can return fewer bytes than requested
+    data = b""
+    while len(data) < how_many_bytes:
+        data += os.read(urandom, how_many_bytes - len(data))
+    return Response(data, content_type="application/octet-stream")
+
+
 if __name__ == "__main__":
     app.run(port=80)
 
@@ -1,8 +1,14 @@
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import hashlib
 import logging
 import os
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 from redis import Redis
 import requests
+from requests.adapters import HTTPAdapter
 import time
+from urllib3.util.retry import Retry
 
 DEBUG = os.environ.get("DEBUG", "").lower().startswith("y")
 
@@ -16,49 +22,259 @@ else:
 
 redis = Redis("redis")
 
+# Metrics are exposed on http://worker:METRICS_PORT/metrics (0 = disabled).
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9150"))
+
+STAGE_SECONDS = Histogram(
+    "dockercoins_worker_stage_seconds",
+    "Time spent in each stage of the work (rng, hash, redis).",
+    ["stage"])
+ERRORS = Counter(
+    "dockercoins_worker_errors_total",
+    "Errors in each stage of the work (rng, hash, redis).",
+    ["stage"])
+UNITS = Counter(
+    "dockercoins_worker_units_total",
+    "Units of work done.")
+UNITS_PER_SECOND = Gauge(
+    "dockercoins_worker_units_per_second",
+    "Units of work done per second (over the last interval).")
+COINS = Counter(
+    "dockercoins_worker_coins_total",
+    "Coins found.")
+IN_FLIGHT = Gauge(
+    "dockercoins_worker_units_in_flight",
+    "Units of work in progress.")
+for name in ("rng", "hash", "redis"):
+    ERRORS.labels(name)
+
+
+@contextlib.contextmanager
+def stage(name):
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        ERRORS.labels(name).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.time() - start)
+
+# Coins and hash counts are buffered, and written to redis in a single
+# pipeline when there are REDIS_FLUSH_SIZE coins in the buffer, or every
+# REDIS_FLUSH_INTERVAL seconds (whichever comes first).
+REDIS_FLUSH_SIZE = int(os.environ.get("REDIS_FLUSH_SIZE", "100"))
+REDIS_FLUSH_INTERVAL = float(os.environ.get("REDIS_FLUSH_INTERVAL", "1"))
+
+# All HTTP requests go through a single session, so that connections
+# to rng and hasher are kept alive and reused (instead of doing a DNS
+# lookup and opening a new TCP connection for each unit of work).
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "10"))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "5"))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", "0.2"))
+
+# With BATCH_SIZE > 1, each request to rng and hasher handles that many
+# blocks at once (instead of one), trading latency for throughput.
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "1"))
+BLOCK_SIZE = 32
+
+# With HASH_MODE=local, the worker computes hashes itself (instead of
+# asking hasher), optionally in HASH_PROCESSES processes (0 = one per CPU).
+# Processes are only used with BATCH_SIZE > 1.
+HASH_MODE = os.environ.get("HASH_MODE", "remote")
+HASH_PROCESSES = int(os.environ.get("HASH_PROCESSES", "1")) or os.cpu_count()
+if HASH_MODE not in ("remote", "local"):
+    raise ValueError("HASH_MODE should be remote or local, not {!r}"
+                     .format(HASH_MODE))
+
+RNG_URL = "http://rng/"
+HASHER_URL = "http://hasher/"
+
+adapter = HTTPAdapter(
+    pool_connections=2, pool_maxsize=HTTP_POOL_SIZE,
+    # Retry connection errors and 5xx errors (hashing is idempotent,
+    # so it's fine to retry POST requests too).
+    max_retries=Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF,
+                      status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=None))
+session = requests.Session()
+session.mount("http://", adapter)
+
+
+def http_stats():
+    # Number of requests sent, and number of connections opened,
+    # to each service since the worker started.
+    requests_done = connections_opened = 0
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools[key]
+        requests_done += pool.num_requests
+        connections_opened += pool.num_connections
+    return requests_done, connections_opened
+
 
 def get_random_bytes():
-    r = requests.get("http://rng/32")
+    r = session.get(RNG_URL + str(BLOCK_SIZE), timeout=HTTP_TIMEOUT)
     return r.content
 
 
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+if HASH_MODE == "local" and HASH_PROCESSES > 1:
+    hash_pool = ProcessPoolExecutor(HASH_PROCESSES)
+else:
+    hash_pool = None
+
+
 def hash_bytes(data):
-    r = requests.post("http://hasher/",
-                      data=data,
-                      headers={"Content-Type": "application/octet-stream"})
+    if HASH_MODE == "local":
+        return sha256(data)
+    r = session.post(HASHER_URL,
+                     data=data,
+                     headers={"Content-Type": "application/octet-stream"},
+                     timeout=HTTP_TIMEOUT)
     hex_hash = r.text
     return hex_hash
 
 
+def get_random_blocks(count):
+    r = session.get(RNG_URL + "batch/{}/{}".format(BLOCK_SIZE, count),
+                    timeout=HTTP_TIMEOUT)
+    r.raise_for_status()
+    data = r.content
+    return [data[i:i+BLOCK_SIZE] for i in range(0, len(data), BLOCK_SIZE)]
+
+
+def hash_blocks(blocks):
+    if HASH_MODE == "local":
+        if hash_pool:
+            chunksize = max(1, len(blocks) // (4 * HASH_PROCESSES))
+            return list(hash_pool.map(sha256, blocks, chunksize=chunksize))
+        return [sha256(block) for block in blocks]
+    r = session.post(HASHER_URL + "batch/{}".format(BLOCK_SIZE),
+                     data=b"".join(blocks),
+                     headers={"Content-Type": "application/octet-stream"},
+                     timeout=HTTP_TIMEOUT)
+    r.raise_for_status()
+    hex_hashes = r.text.split("\n")
+    if len(hex_hashes) != len(blocks):
+        raise Exception("Sent {} blocks to hasher but got {} hashes"
+                        .format(len(blocks), len(hex_hashes)))
+    return hex_hashes
+
+
+class RedisBuffer(object):
+
+    def __init__(self):
+        self.coins = {}
+        self.hashes = 0
+        self.deadline = time.time() + REDIS_FLUSH_INTERVAL
+
+    def add_coin(self, hex_hash, random_bytes):
+        self.coins[hex_hash] = random_bytes
+
+    def add_hashes(self, count):
+        self.hashes += count
+
+    def maybe_flush(self):
+        if len(self.coins) >= REDIS_FLUSH_SIZE or time.time() >= self.deadline:
+            self.flush()
+
+    def flush(self):
+        self.deadline = time.time() + REDIS_FLUSH_INTERVAL
+        if not self.coins and not self.hashes:
+            return
+        start = time.time()
+        pipeline = redis.pipeline(transaction=False)
+        for hex_hash, random_bytes in self.coins.items():
+            pipeline.hset("wallet", hex_hash, random_bytes)
+        pipeline.incrby("hashes", self.hashes)
+        with stage("redis"):
+            results = pipeline.execute()
+        for hex_hash, created in zip(self.coins, results):
+            if not created:
+                log.info("We already had that coin: {}...".format(hex_hash[:8]))
+        log.info("Wrote {} coins and {} hashes to redis in {:.1f}ms"
+                 .format(len(self.coins), self.hashes,
+                         1000 * (time.time() - start)))
+        self.coins = {}
+        self.hashes = 0
+
+
+redis_buffer = RedisBuffer()
+
+
 def work_loop(interval=1):
     deadline = 0
     loops_done = 0
+    last_time = time.time()
+    last_stats = http_stats()
     while True:
         if time.time() > deadline:
-            log.info("{} units of work done, updating hash counter"
-                     .format(loops_done))
-            redis.incrby("hashes", loops_done)
+            stats = http_stats()
+            log.info("{} units of work done "
+                     "({} HTTP requests, {} new connections)"
+                     .format(loops_done, stats[0] - last_stats[0],
+                             stats[1] - last_stats[1]))
+            last_stats = stats
+            UNITS_PER_SECOND.set(loops_done / (time.time() - last_time))
+            last_time = time.time()
             loops_done = 0
             deadline = time.time() + interval
-        work_once()
-        loops_done += 1
+        units_done = BATCH_SIZE if BATCH_SIZE > 1 else 1
+        IN_FLIGHT.inc(units_done)
+        try:
+            if BATCH_SIZE > 1:
+                work_batch(BATCH_SIZE)
+            else:
+                work_once()
+        finally:
+            IN_FLIGHT.dec(units_done)
+        UNITS.inc(units_done)
+        loops_done += units_done
+        redis_buffer.add_hashes(units_done)
+        redis_buffer.maybe_flush()
 
 
 def work_once():
     log.debug("Doing one unit of work")
     time.sleep(0.1)
-    random_bytes = get_random_bytes()
-    hex_hash = hash_bytes(random_bytes)
+    with stage("rng"):
+        random_bytes = get_random_bytes()
+    with stage("hash"):
+        hex_hash = hash_bytes(random_bytes)
+    check_hash(random_bytes, hex_hash)
+
+
+def work_batch(count):
+    log.debug("Doing {} units of work".format(count))
+    start = time.time()
+    time.sleep(0.1)
+    with stage("rng"):
+        blocks = get_random_blocks(count)
+    with stage("hash"):
+        hex_hashes = hash_blocks(blocks)
+    for random_bytes, hex_hash in zip(blocks, hex_hashes):
+        check_hash(random_bytes, hex_hash)
+    log.debug("Batch of {} units done in {:.3f}s"
+              .format(count, time.time() - start))
+
+
+def check_hash(random_bytes, hex_hash):
     if not hex_hash.startswith('0'):
         log.debug("No coin found")
         return
     log.info("Coin found: {}...".format(hex_hash[:8]))
-    created = redis.hset("wallet", hex_hash, random_bytes)
-    if not created:
-        log.info("We already had that coin")
+    COINS.inc()
+    redis_buffer.add_coin(hex_hash, random_bytes)
 
 
 if __name__ == "__main__":
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
     while True:
         try:
             work_loop()
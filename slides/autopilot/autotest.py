@@ -1,14 +1,22 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import argparse
+import atexit
 import click
+import json
 import logging
 import os
 import random
 import re
 import select
+import shlex
+import queue
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import uuid
 import yaml
@@ -69,8 +77,6 @@ class State(object):
 state = State()
 
 
-outfile = open("autopilot.log", "w")
-
 def hrule():
     return "="*int(subprocess.check_output(["tput", "cols"]))
 
@@ -78,13 +84,14 @@ def hrule():
 # Most of the "snippets" are shell commands.
 # Some of them can be key strokes or other actions.
 # In the markdown source, they are the code sections (identified by triple-
-# quotes) within .exercise[] sections.
+# quotes) within .lab[] sections (formerly known as .exercise[]).
 
 class Snippet(object):
 
     def __init__(self, slide, content):
         self.slide = slide
         self.content = content
+        self.next = None
         # Extract the "method" (e.g. bash, keys, ...)
         # On multi-line snippets, the method is alone on the first line
         # On single-line snippets, the data follows the method immediately
@@ -95,7 +102,6 @@ class Snippet(object):
             self.method, self.data = content.split(' ', 1)
         else:
             self.method, self.data = content, None
-        self.next = None
 
     def __str__(self):
         return self.content
@@ -105,17 +111,34 @@ class Slide(object):
 
     current_slide = 0
 
-    def __init__(self, content):
+    # "index" is the entry of that slide in a slide index (see load_index).
+    def __init__(self, content, index=None):
         self.number = Slide.current_slide
         Slide.current_slide += 1
 
+        self.part = None
+        if index is not None:
+            self.content = content
+            # Part 0 is everything before the first part of the TOC.
+            self.part = index.get("part") or 0
+            self.snippets = [
+                Snippet(self, content[s["start"]:s["end"]])
+                for s in index["snippets"]]
+            for snippet, s in zip(self.snippets, index["snippets"]):
+                if s["next"] is not None:
+                    snippet.next = self.snippets[s["next"]]
+            for i in range(index["exercises_without_snippets"]):
+                logging.warning("Exercise on slide {} does not have any ``` snippet."
+                                .format(self.number))
+            return
+
         # Remove commented-out slides
         # (remark.js considers ??? to be the separator for speaker notes)
         content = re.split("\n\?\?\?\n", content)[0]
         self.content = content
 
         self.snippets = []
-        exercises = re.findall("\.exercise\[(.*)\]", content, re.DOTALL)
+        exercises = re.findall("\.(?:exercise|lab)\[(.*)\]", content, re.DOTALL)
         for exercise in exercises:
             if "```" in exercise:
                 previous = None
@@ -170,6 +193,282 @@ def interruptible_sleep(t):
     return 0 in rfds
 
 
+# Running tmux commands. By default, we keep a single tmux client in
+# control mode ("tmux -C"), send it our commands, and read their output,
+# instead of running a new tmux process for each command.
+# Set TMUX_TRANSPORT=subprocess to run a tmux process for each command
+# (that's also what happens if control mode doesn't work).
+class TmuxError(Exception):
+    pass
+
+
+# When driving a specific session (--session), we need to add "-t <session>"
+# to the tmux commands. This is done for the commands that we use, and for
+# the most common commands in tmux snippets (other commands in tmux snippets
+# will use the default session). The table gives the kind of target of each
+# command; snippets can also use their aliases (e.g. "splitw", "selectl").
+# If a snippet has its own target (e.g. "select-pane -t 0"), that target is
+# qualified with the session name, so that it doesn't pick a pane in the
+# session of the last tmux client that was used.
+class SubprocessTransport(object):
+
+    targets = {
+        "capture-pane": "pane", "display-message": "pane", "has-session": "session",
+        "kill-pane": "pane", "last-pane": "window", "last-window": "session",
+        "new-window": "window", "pipe-pane": "pane", "resize-pane": "pane",
+        "select-layout": "pane", "select-pane": "pane", "select-window": "window",
+        "send-keys": "pane", "split-window": "pane",
+    }
+
+    aliases = {
+        "capturep": "capture-pane", "display": "display-message", "has": "has-session",
+        "killp": "kill-pane", "last": "last-window", "lastp": "last-pane",
+        "neww": "new-window", "pipep": "pipe-pane", "resizep": "resize-pane",
+        "selectl": "select-layout", "selectp": "select-pane", "selectw": "select-window",
+        "send": "send-keys", "split-pane": "split-window", "splitw": "split-window",
+    }
+
+    def __init__(self, session=None):
+        self.session = session
+
+    # Returns the target to use for a command of that kind; "target" is
+    # the target given in the command, if any.
+    def target(self, kind, target=None):
+        if target is None:
+            return self.session + (":" if kind == "window" else "")
+        # Unique IDs ($session, @window, %pane) and targets that already
+        # include a session are left alone.
+        if kind == "session" or target[:1] in "$@%" or ":" in target:
+            return target
+        if kind == "window" or "." in target:
+            return "{}:{}".format(self.session, target)
+        return "{}:.{}".format(self.session, target)
+
+    def run(self, args):
+        kind = self.targets.get(self.aliases.get(args[0], args[0]))
+        if self.session and kind:
+            if "-t" in args[1:-1]:
+                i = args.index("-t") + 1
+                args = args[:i] + [self.target(kind, args[i])] + args[i+1:]
+            elif "-t" not in args:
+                args = args[:1] + ["-t", self.target(kind)] + args[1:]
+        # On the command line, tmux treats arguments ending with ";" as
+        # command separators, unless the ";" is escaped with a backslash.
+        # (Control mode has its own quoting; see ControlTransport.quote.)
+        args = [arg[:-1] + "\\;" if arg.endswith(";") else arg for arg in args]
+        process = subprocess.run(["tmux"] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode:
+            raise TmuxError("tmux {} failed: {}".format(
+                " ".join(args), process.stderr.decode("utf-8", "replace").strip()))
+        return process.stdout.decode("utf-8")
+
+
+# In control mode, the output of each command is framed between
+# "%begin <time> <number> <flags>" and "%end" (or "%error") lines;
+# flags is 1 for the commands that we sent (the attach-session command
+# given on the command line, for instance, has 0). Outside of these
+# frames, tmux sends notifications; "%output" means that a pane has
+# new output (see ControlWatcher).
+class ControlTransport(object):
+
+    def __init__(self, session=None):
+        target = ["-t", session] if session else []
+        self.process = subprocess.Popen(
+            ["tmux", "-C", "attach-session", "-f", "ignore-size"] + target,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.responses = queue.Queue()
+        self.lock = threading.Lock()
+        self.output_r, self.output_w = os.pipe()
+        os.set_blocking(self.output_r, False)
+        os.set_blocking(self.output_w, False)
+        threading.Thread(target=self.read, daemon=True).start()
+        # Wait until we're attached (or until tmux tells us why we can't).
+        flags, ok, lines = self.responses.get(timeout=TIMEOUT)
+        if not ok:
+            raise TmuxError("Could not attach to tmux: {}".format(" ".join(lines)))
+        atexit.register(self.close)
+
+    def read(self):
+        frame = None
+        for line in self.process.stdout:
+            line = line.decode("utf-8", "replace").rstrip("\n")
+            if frame is None:
+                if line.startswith("%begin "):
+                    frame = (line.split()[1:], [])
+                elif line.startswith("%output "):
+                    try:
+                        os.write(self.output_w, b"!")
+                    except BlockingIOError:
+                        pass
+                continue
+            # The pane could show "%end" too, so check that the frame matches.
+            words = line.split()
+            if words[:1] in (["%end"], ["%error"]) and words[1:] == frame[0]:
+                self.responses.put((words[3], words[0] == "%end", frame[1]))
+                frame = None
+            else:
+                frame[1].append(line)
+        # tmux went away; wake up whoever is waiting for a response.
+        self.responses.put(("1", False, ["tmux control client exited"]))
+
+    # Quote an argument for the tmux command parser.
+    @staticmethod
+    def quote(arg):
+        quoted = ""
+        for c in arg:
+            if c in '\\"$':
+                quoted += "\\" + c
+            elif c == "\n":
+                quoted += "\\n"
+            elif ord(c) < 32 or ord(c) == 127:
+                quoted += "\\{:03o}".format(ord(c))
+            else:
+                quoted += c
+        return '"{}"'.format(quoted)
+
+    def run(self, args):
+        with self.lock:
+            command = " ".join(self.quote(arg) for arg in args) + "\n"
+            self.process.stdin.write(command.encode("utf-8"))
+            self.process.stdin.flush()
+            while True:
+                flags, ok, lines = self.responses.get()
+                if flags == "1":
+                    break
+        if not ok:
+            raise TmuxError("tmux {} failed: {}".format(" ".join(args), " ".join(lines)))
+        return "".join(line + "\n" for line in lines)
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def make_transport(session=None):
+    if os.environ.get("TMUX_TRANSPORT", "control") == "control":
+        try:
+            transport = ControlTransport(session)
+            logging.debug("Connected to tmux in control mode.")
+            return transport
+        except Exception as e:
+            logging.warning("Could not use tmux control mode ({}); running tmux commands instead."
+                            .format(e))
+    return SubprocessTransport(session)
+
+
+transport = SubprocessTransport()
+
+
+def tmux(*args):
+    return transport.run(list(args))
+
+
+# Wait until there is something to read on fd (and read it), at most t seconds.
+# Like interruptible_sleep, returns True if interrupted by pressing ENTER.
+# When a command prints continuously, we don't want to check the screen
+# each time something is written; so after waking up because of some
+# output, we wait at least CAPTURE_INTERVAL before waking up again.
+CAPTURE_INTERVAL = float(os.environ.get("CAPTURE_INTERVAL", "0.1"))
+last_output_wakeup = 0
+
+
+def wait_for_fd(fd, t):
+    global last_output_wakeup
+    rfds, _, _ = select.select([0, fd], [], [], t)
+    if 0 in rfds:
+        return True
+    if fd in rfds:
+        delay = last_output_wakeup + CAPTURE_INTERVAL - time.time()
+        if delay > 0 and interruptible_sleep(delay):
+            return True
+        try:
+            while os.read(fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        last_output_wakeup = time.time()
+    return False
+
+
+# Watching the output of the tmux pane, so that we can check the screen
+# as soon as something changes, instead of checking it every second.
+# PaneWatcher streams the output of the pane to a FIFO with "tmux pipe-pane".
+# The FIFO only gets data when the tmux server runs on this machine; with
+# a remote tmux server, we still check the screen at least every second.
+# In control mode, tmux notifies us of the output of the panes anyway,
+# so we use that instead (see ControlWatcher).
+# Set WATCH_OUTPUT=poll to only check the screen every second.
+class PaneWatcher(object):
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="autotest-")
+        self.fifo = os.path.join(self.directory, "output")
+        os.mkfifo(self.fifo)
+        self.fd = os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK)
+        # Also keep the FIFO open for writing, so that we never see EOF
+        # (e.g. when the pipe gets attached to another pane).
+        self.keepalive = os.open(self.fifo, os.O_WRONLY)
+        atexit.register(self.close)
+
+    # Stream the output of the current pane to the FIFO.
+    # This must be done again when the current pane changes.
+    def attach(self):
+        tmux("pipe-pane", "cat >> {}".format(shlex.quote(self.fifo)))
+
+    def close(self):
+        try:
+            tmux("pipe-pane")
+        except Exception:
+            pass
+        os.close(self.fd)
+        os.close(self.keepalive)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # Wait until the pane shows some output, at most t seconds.
+    def wait(self, t):
+        return wait_for_fd(self.fd, t)
+
+
+class ControlWatcher(object):
+
+    def __init__(self, transport):
+        self.fd = transport.output_r
+
+    def attach(self):
+        pass
+
+    def wait(self, t):
+        return wait_for_fd(self.fd, t)
+
+
+class PollingWatcher(object):
+
+    def attach(self):
+        pass
+
+    def wait(self, t):
+        return interruptible_sleep(t)
+
+
+def make_watcher():
+    if os.environ.get("WATCH_OUTPUT", "pipe") == "poll":
+        return PollingWatcher()
+    if isinstance(transport, ControlTransport):
+        return ControlWatcher(transport)
+    if os.environ.get("WATCH_OUTPUT", "pipe") == "pipe":
+        try:
+            watcher = PaneWatcher()
+            watcher.attach()
+            logging.debug("Watching pane output in {}.".format(watcher.fifo))
+            return watcher
+        except Exception:
+            logging.exception("Could not watch pane output; polling instead.")
+    return PollingWatcher()
+
+
+watcher = PollingWatcher()
+
+
 def wait_for_string(s, timeout=TIMEOUT):
     logging.debug("Waiting for string: {}".format(s))
     deadline = time.time() + timeout
@@ -177,7 +476,7 @@ def wait_for_string(s, timeout=TIMEOUT):
         output = capture_pane()
         if s in output:
             return
-        if interruptible_sleep(1): return
+        if watcher.wait(1): return
     raise Exception("Timed out while waiting for {}!".format(s))
 
 
@@ -201,13 +500,71 @@ def wait_for_prompt():
         # We did not recognize a known prompt; wait a bit and check again
         logging.debug("Could not find a known prompt on last line: {!r}"
                       .format(last_line))
-        if interruptible_sleep(1): return
+        if watcher.wait(1): return
     raise Exception("Timed out while waiting for prompt!")
 
 
+# With EXIT_STATUS=prompt, we set up PROMPT_COMMAND in the shell of the
+# tmux pane, so that before each prompt, it puts a sequence number and
+# the exit status of the last command in the title of the pane (with an
+# escape sequence). This goes through the terminal, so it also works when
+# the shell is on another machine, and we can read it right away with
+# "tmux display-message", instead of typing "echo $?" and then waiting
+# for the prompt and scanning the screen to find the result.
+# Shells started later (e.g. in a container, or on another node) don't
+# have this PROMPT_COMMAND; then we fall back to "echo $?".
+# The setup can run multiple times in the same shell (e.g. when autotest
+# resumes, or when batch.py runs several parts in the same session): the
+# original PROMPT_COMMAND is saved the first time, and ours is rebuilt from
+# it each time, so that there is only one copy of ours (a second copy
+# would see the exit status of the first one's printf).
+# The title also has an ID generated by each run of autotest, so that we
+# only trust titles set by a shell that this run has set up.
+EXIT_STATUS_ID = uuid.uuid4().hex[:12]
+EXIT_STATUS_PROMPT_COMMAND = (
+    " __autotest_id=" + EXIT_STATUS_ID + "; "
+    "__autotest_orig_pc=${__autotest_orig_pc-$PROMPT_COMMAND}; "
+    "PROMPT_COMMAND='__autotest_status=$?; __autotest_seq=$((__autotest_seq+1)); "
+    "printf \"\\033]2;autotest %s %s %s\\007\" $__autotest_id $__autotest_seq $__autotest_status'"
+    "\"${__autotest_orig_pc:+; $__autotest_orig_pc}\"\n")
+
+# Sequence number shown in the title of the pane when we sent the last
+# command (or None if we can't get the exit status from the title).
+last_command_seq = None
+
+
+def setup_exit_status():
+    if os.environ.get("EXIT_STATUS", "echo") != "prompt":
+        return
+    tmux("send-keys", EXIT_STATUS_PROMPT_COMMAND)
+    time.sleep(0.5)
+    wait_for_prompt()
+    if read_exit_status()[0] is None:
+        logging.warning("Could not set up PROMPT_COMMAND to get exit status.")
+
+
+# Returns (sequence number, exit status) from the title of the pane,
+# or (None, None) if the title wasn't set by the PROMPT_COMMAND that
+# this run of autotest has set up.
+def read_exit_status():
+    words = tmux("display-message", "-p", "#{pane_title}").split()
+    if (len(words) == 4 and words[0] == "autotest" and words[1] == EXIT_STATUS_ID
+            and words[2].isdigit() and words[3].isdigit()):
+        return int(words[2]), int(words[3])
+    return None, None
+
+
 def check_exit_status():
     if not state.verify_status:
         return
+    if last_command_seq is not None:
+        seq, code = read_exit_status()
+        if seq is not None and seq > last_command_seq:
+            logging.debug("Got exit status from pane title: {}.".format(code))
+            if code != 0:
+                raise Exception("Non-zero exit status: {}.".format(code))
+            return
+        logging.debug("Could not get exit status from pane title; asking the shell.")
     token = uuid.uuid4().hex
     data = "echo {} $?\n".format(token)
     logging.debug("Sending {!r} to get exit status.".format(data))
@@ -228,7 +585,14 @@ def check_exit_status():
 
 
 def setup_tmux_and_ssh():
-    if subprocess.call(["tmux", "has-session"]):
+    global transport
+    transport = make_transport(args.session)
+    try:
+        tmux("has-session")
+        has_session = True
+    except TmuxError:
+        has_session = False
+    if not has_session:
         logging.error("Couldn't connect to tmux. Please setup tmux first.")
         ipaddr = "$IPADDR"
         uid = os.getuid()
@@ -260,31 +624,102 @@ export PS1="\n[{ipaddr}] \u@\h:\w\n\$ "
 """.format(uid=uid, ipaddr=ipaddr))
     else:
         logging.info("Found tmux session. Trying to acquire shell prompt.")
+        global watcher
+        watcher = make_watcher()
         wait_for_prompt()
+        setup_exit_status()
     logging.info("Successfully connected to test cluster in tmux session.")
 
 
-slides = [Slide("Dummy slide zero")]
-content = open(sys.argv[1]).read()
-
-# OK, this part is definitely hackish, and will break if the
-# excludedClasses parameter is not on a single line.
-excluded_classes = re.findall("excludedClasses: (\[.*\])", content)
-excluded_classes = set(eval(excluded_classes[0]))
+# markmaker.py saves an index of the slides of each deck next to the HTML
+# file (foo.yml.slides.json). It has the position of each slide in the HTML
+# file, and the position of the snippets in each slide, so we don't need to
+# parse the whole HTML file. We use it if it's up to date (otherwise, we
+# fall back to parsing the HTML file).
+# The index can also be given directly on the command line.
+def find_index(filename):
+    if filename.endswith(".slides.json"):
+        return filename
+    if filename.endswith(".html"):
+        index_file = filename[:-len(".html")] + ".slides.json"
+        if (os.path.exists(index_file) and
+                os.path.getmtime(index_file) >= os.path.getmtime(filename)):
+            return index_file
+    return None
+
+
+def load_index(index_file):
+    logging.debug("Loading slide index from {}.".format(index_file))
+    index = json.load(open(index_file))
+    html_file = index_file[:-len(".slides.json")] + ".html"
+    content = open(html_file).read()
+    if len(content) != index["length"]:
+        raise Exception("Slide index {} does not match {}; regenerate it with markmaker.py."
+                        .format(index_file, html_file))
+    for slide in index["slides"]:
+        slides.append(Slide(content[slide["start"]:slide["end"]], slide))
+
+
+def load_html(html_file):
+    logging.debug("Parsing slides from {}.".format(html_file))
+    content = open(html_file).read()
+
+    # OK, this part is definitely hackish, and will break if the
+    # excludedClasses parameter is not on a single line.
+    # (Older versions of workshop.html had it right there; now it's
+    # passed through the tmpl() function.)
+    excluded_classes = (
+        re.findall("excludedClasses: (\[.*\])", content) or
+        re.findall("tmplEXCLUDE = tmpl\(.*, '(\[.*\])', \[\]\)", content))
+    excluded_classes = set(json.loads(excluded_classes[0]))
+
+    for slide in re.split("\n---?\n", content):
+        slide_classes = re.findall("class: (.*)", slide)
+        if slide_classes:
+            slide_classes = slide_classes[0].split(",")
+            slide_classes = [c.strip() for c in slide_classes]
+        if excluded_classes & set(slide_classes):
+            logging.debug("Skipping excluded slide.")
+            continue
+        slides.append(Slide(slide))
+
+
+parser = argparse.ArgumentParser(
+    description="Run the commands shown in a deck, in a tmux session.")
+parser.add_argument("deck", metavar="HTML",
+    help="deck generated by markmaker.py (or its .slides.json index)")
+parser.add_argument("--session",
+    help="tmux session to use (default: the current or most recent one)")
+parser.add_argument("--part", type=int,
+    help="run the snippets of that part of the deck (non-interactively) "
+         "and exit; part 0 is everything before the first part "
+         "(this requires the slide index; see batch.py)")
+parser.add_argument("--log", default="autopilot.log",
+    help="where to log the result of each snippet (default: %(default)s)")
+args = parser.parse_args()
+
+outfile = open(args.log, "w")
 
-for slide in re.split("\n---?\n", content):
-    slide_classes = re.findall("class: (.*)", slide)
-    if slide_classes:
-        slide_classes = slide_classes[0].split(",")
-        slide_classes = [c.strip() for c in slide_classes]
-    if excluded_classes & set(slide_classes):
-        logging.debug("Skipping excluded slide.")
-        continue
-    slides.append(Slide(slide))
+slides = [Slide("Dummy slide zero")]
+index_file = find_index(args.deck)
+if index_file:
+    load_index(index_file)
+else:
+    load_html(args.deck)
+
+# Slides of the part that we're running (with --part).
+part_slides = [slide.number for slide in slides
+               if args.part is not None and slide.part == args.part]
+if args.part is not None and not part_slides:
+    raise Exception("Could not find slides for part {} (is the slide index up to date?)"
+                    .format(args.part))
+# We stop after that one (move_forward() would loop on the last slide of the deck).
+part_snippets = [snippet for number in part_slides for snippet in slides[number].snippets]
+last_snippet = part_snippets[-1] if part_snippets else None
 
 
 def capture_pane():
-    return subprocess.check_output(["tmux", "capture-pane", "-p"]).decode('utf-8')
+    return tmux("capture-pane", "-p")
 
 
 setup_tmux_and_ssh()
@@ -301,6 +736,13 @@ except Exception as e:
     logging.exception("Could not load state from file.")
     logging.warning("Using default values.")
 
+if part_slides:
+    logging.info("Running part {} (slides {} to {}).".format(
+        args.part, part_slides[0], part_slides[-1]))
+    state.slide = part_slides[0]
+    state.snippet = 0
+    state.interactive = False
+
 
 def move_forward():
     state.snippet += 1
@@ -333,7 +775,7 @@ def check_bounds():
 
 
 def send_keys(keys):
-    subprocess.check_call(["tmux", "send-keys", keys])
+    tmux("send-keys", keys)
 
 # Send a single key.
 # Useful for special keys, e.g. tmux interprets these strings:
@@ -354,8 +796,6 @@ def action_keys(state, snippet, keys=None):
         send_keys(keys)
     else:
         for key in keys:
-            if key == ";":
-                key = "\\;"
             if key == "\n":
                 if interruptible_sleep(1): return
             send_keys(key)
@@ -379,6 +819,10 @@ def action_bash(state, snippet):
     data = data.replace('`', '')
     # Add "RETURN" at the end of the command :)
     data += "\n"
+    # Remember where we were, to get the exit status of that command later
+    global last_command_seq
+    if state.verify_status and os.environ.get("EXIT_STATUS", "echo") == "prompt":
+        last_command_seq = read_exit_status()[0]
     # Send command
     action_keys(state, snippet, data)
     # Force a short sleep to avoid race condition
@@ -430,7 +874,9 @@ def action_open(state, snippet):
 
 
 def action_tmux(state, snippet):
-    subprocess.check_call(["tmux"] + snippet.data.split())
+    tmux(*snippet.data.split())
+    # The current pane might have changed.
+    watcher.attach()
 
 
 def action_unknown(state, snippet):
@@ -443,6 +889,7 @@ def run_snippet(state, snippet):
         action = globals()["action_"+snippet.method]
     except KeyError:
         action = action_unknown
+    start = time.time()
     try:
         action(state, snippet)
         result = "OK"
@@ -453,13 +900,18 @@ def run_snippet(state, snippet):
         try:
             wait_for_prompt()
         except:
-            subprocess.check_call(["tmux", "new-window"])
+            tmux("new-window")
+            watcher.attach()
             wait_for_prompt()
-    outfile.write("{} SLIDE={} METHOD={} DATA={!r}\n".format(result, state.slide, snippet.method, snippet.data))
+    outfile.write("{} SLIDE={} METHOD={} DATA={!r} TIME={:.2f}\n".format(
+        result, state.slide, snippet.method, snippet.data, time.time() - start))
     outfile.flush()
 
 
 while True:
+    if part_slides and state.slide > part_slides[-1]:
+        logging.info("Done with part {}.".format(args.part))
+        break
     state.save()
     slide = slides[state.slide]
     if state.snippet and state.snippet <= len(slide.snippets):
@@ -529,6 +981,9 @@ while True:
     elif command in ("y", "\r", " "):
         if snippet:
             run_snippet(state, snippet)
+            if part_slides and snippet is last_snippet:
+                logging.info("Done with part {}.".format(args.part))
+                break
             move_forward()
         else:
             # Advance to next snippet
@@ -539,6 +994,10 @@ while True:
                 if state.slide == len(slides)-1:
                     break
             # And then advance to the snippet
+            position = (state.slide, state.snippet)
             move_forward()
+            # If we're running a part and we can't move anymore, we're done.
+            if part_slides and (state.slide, state.snippet) == position:
+                break
     else:
         logging.warning("Unknown command {}.".format(command))
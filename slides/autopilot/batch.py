@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Run all the snippets of a deck, in parallel, in multiple tmux sessions
+# (e.g. one session per lab node, each with a shell on that node).
+# The deck is split according to the parts of its table of contents
+# (using the slide index generated by markmaker.py, foo.yml.slides.json).
+# Each part is run by "autotest.py --part N" in one of the sessions, as soon
+# as a session is available; everything before the first part is part 0.
+# Each part runs in its own directory (with its own autopilot.log and
+# state.yaml). At the end, the logs of all parts are merged into a single
+# autopilot.log, and we show a summary with the slowest slides.
+#
+# Example:
+# ./batch.py ../kube-selfpaced.yml.html --sessions node1,node2,node3
+
+import argparse
+import json
+import logging
+import os
+import queue
+import re
+import subprocess
+import sys
+import threading
+import time
+
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
+
+AUTOTEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "autotest.py")
+
+LOG_LINE = re.compile("^(\w+) SLIDE=(\d+) .* TIME=([0-9.]+)$")
+
+
+def find_index(filename):
+    if filename.endswith(".slides.json"):
+        return filename
+    index_file = re.sub("\.html$", "", filename) + ".slides.json"
+    if not os.path.exists(index_file):
+        raise Exception("Could not find slide index {}; generate it with markmaker.py first."
+                        .format(index_file))
+    if filename.endswith(".html") and os.path.getmtime(index_file) < os.path.getmtime(filename):
+        logging.warning("Slide index {} is older than {}.".format(index_file, filename))
+    return index_file
+
+
+# Returns the list of parts that have snippets, in order.
+def find_parts(index_file):
+    index = json.load(open(index_file))
+    parts = []
+    for slide in index["slides"]:
+        part = slide.get("part") or 0
+        if slide["snippets"] and part not in parts:
+            parts.append(part)
+    return parts
+
+
+class Result(object):
+
+    def __init__(self, part, session, directory):
+        self.part = part
+        self.session = session
+        self.directory = directory
+        self.log = os.path.join(directory, "autopilot.log")
+        self.returncode = None
+        self.elapsed = 0
+        self.lines = []
+
+    def load(self):
+        if os.path.exists(self.log):
+            self.lines = open(self.log).read().splitlines()
+
+    def count(self, result):
+        return len([line for line in self.lines if line.startswith(result + " ")])
+
+
+def run_part(index_file, part, session, workdir):
+    directory = os.path.join(workdir, "part-{}".format(part))
+    os.makedirs(directory, exist_ok=True)
+    result = Result(part, session, directory)
+    logging.info("Running part {} in session {}.".format(part, session))
+    start = time.time()
+    with open(os.path.join(directory, "console.log"), "w") as console:
+        # autotest.py watches its stdin (pressing ENTER interrupts waits),
+        # so give it a pipe that stays open and silent.
+        process = subprocess.Popen(
+            [sys.executable, AUTOTEST, os.path.abspath(index_file),
+             "--session", session, "--part", str(part)],
+            cwd=directory, stdin=subprocess.PIPE, stdout=console, stderr=subprocess.STDOUT)
+        result.returncode = process.wait()
+        process.stdin.close()
+    result.elapsed = time.time() - start
+    result.load()
+    logging.info("Part {} done in {:.1f}s ({} OK, {} ERR).".format(
+        part, result.elapsed, result.count("OK"), result.count("ERR")))
+    if result.returncode:
+        logging.error("autotest.py exited with status {} for part {}; see {}.".format(
+            result.returncode, part, os.path.join(directory, "console.log")))
+    return result
+
+
+# Each session runs one part at a time, until there are no parts left.
+def worker(index_file, parts, session, workdir, results):
+    while True:
+        try:
+            part = parts.get_nowait()
+        except queue.Empty:
+            return
+        results[part] = run_part(index_file, part, session, workdir)
+
+
+def summary(results, parts, elapsed, top):
+    print("{:>6} {:<16} {:>6} {:>6} {:>9}".format("part", "session", "OK", "ERR", "seconds"))
+    for part in parts:
+        result = results[part]
+        print("{:>6} {:<16} {:>6} {:>6} {:>9.1f}".format(
+            part, result.session, result.count("OK"), result.count("ERR"), result.elapsed))
+    print("Total: {:.1f}s (sequential: {:.1f}s).".format(
+        elapsed, sum(results[part].elapsed for part in parts)))
+    slide_times = {}
+    for part in parts:
+        for line in results[part].lines:
+            match = LOG_LINE.match(line)
+            if match:
+                slide = int(match.group(2))
+                slide_times[slide] = slide_times.get(slide, 0) + float(match.group(3))
+    if slide_times:
+        print("\nSlowest slides:")
+        for slide in sorted(slide_times, key=slide_times.get, reverse=True)[:top]:
+            print("{:>6} {:>9.1f}s".format(slide, slide_times[slide]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the snippets of a deck in parallel, in multiple tmux sessions.")
+    parser.add_argument("deck", metavar="HTML",
+        help="deck generated by markmaker.py (or its .slides.json index)")
+    parser.add_argument("--sessions", required=True,
+        help="comma-separated list of tmux sessions to use")
+    parser.add_argument("--parts",
+        help="comma-separated list of parts to run (default: all the parts with snippets)")
+    parser.add_argument("--workdir", default="batch",
+        help="where to put the logs of each part (default: %(default)s)")
+    parser.add_argument("--log", default="autopilot.log",
+        help="where to write the merged log (default: %(default)s)")
+    parser.add_argument("--top", type=int, default=10,
+        help="how many of the slowest slides to show (default: %(default)s)")
+    args = parser.parse_args()
+
+    index_file = find_index(args.deck)
+    if args.parts:
+        parts = [int(part) for part in args.parts.split(",")]
+    else:
+        parts = find_parts(index_file)
+    sessions = args.sessions.split(",")
+    logging.info("Running {} parts in {} sessions.".format(len(parts), len(sessions)))
+
+    todo = queue.Queue()
+    for part in parts:
+        todo.put(part)
+    results = {}
+    start = time.time()
+    threads = [
+        threading.Thread(target=worker, args=(index_file, todo, session, args.workdir, results))
+        for session in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    # Parts are contiguous ranges of slides, so the merged log is in slide order.
+    with open(args.log, "w") as f:
+        for part in parts:
+            for line in results[part].lines:
+                f.write(line + "\n")
+    summary(results, parts, elapsed, args.top)
+    if any(results[part].returncode or results[part].count("ERR") for part in parts):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Benchmark @@-string expansion: the legacy implementation of
+# markmaker.processAtAtStrings (one str.replace per @@-string, plus one
+# full-text replace per @@LINK/@@INCLUDE) against the single-pass one.
+# Usage (from the slides directory): bench/atat.py [manifest.yml] [rounds]
+
+import glob
+import logging
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING"))
+import markmaker
+
+
+def legacy_processAtAtStrings(text, manifest):
+    text = text.replace("@@CHAT@@", manifest["chat"])
+    text = text.replace("@@GITREPO@@", manifest["gitrepo"])
+    text = text.replace("@@SLIDES@@", manifest["slides"])
+    text = text.replace("@@ZIP@@", manifest["zip"])
+    text = text.replace("@@HTML@@", manifest["html"])
+    text = text.replace("@@TITLE@@", manifest["title"].replace("\n", "<br/>"))
+    local_anchor_path = ".."
+    online_anchor_path = "https://github.com/jpetazzo/container.training/tree/main"
+    for atatlink in re.findall(r"@@LINK\[[^]]*\]", text):
+        file_name = atatlink[len("@@LINK["):-1]
+        text = text.replace(atatlink, "[{}]({}/{})".format(file_name, online_anchor_path, file_name ))
+    for atatinclude in re.findall(r"@@INCLUDE\[[^]]*\]", text):
+        file_name = atatinclude[len("@@INCLUDE["):-1]
+        file_path = os.path.join(local_anchor_path, file_name)
+        text = text.replace(atatinclude, open(file_path).read())
+    return text
+
+
+def timeit(function, texts, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        for text in texts:
+            function(text)
+    return time.perf_counter() - start
+
+
+filename = sys.argv[1] if len(sys.argv) > 1 else "kube-selfpaced.yml"
+rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+manifest = markmaker.loadmanifest(filename)
+markmaker.manifest = manifest
+
+# The markdown files used by the decks (other .md files, like README.md,
+# can mention @@-directives without expecting them to be expanded).
+files = sorted(set(f for deck in glob.glob("*.yml")
+                   for f in markmaker.contentfiles(markmaker.loadmanifest(deck)["content"])))
+texts = [open(f).read() for f in files]
+
+for f, text in zip(files, texts):
+    if legacy_processAtAtStrings(text, manifest) != markmaker.processAtAtStrings(text):
+        logging.error("Output mismatch on {}.".format(f))
+        sys.exit(1)
+
+before = timeit(lambda text: legacy_processAtAtStrings(text, manifest), texts, rounds)
+after = timeit(markmaker.processAtAtStrings, texts, rounds)
+per_file = lambda total: 1e6 * total / rounds / len(texts)
+print("{} markdown files, {} bytes, {} rounds".format(
+    len(texts), sum(len(t) for t in texts), rounds))
+print("before: {:8.1f} µs/file".format(per_file(before)))
+print("after:  {:8.1f} µs/file".format(per_file(after)))
+print("speedup: {:.2f}x".format(before / after))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Benchmark the slides toolchain (markmaker.py, count-slides.py, index.py).
+# Builds every deck (one markmaker.py process per deck, like build.sh used
+# to do, to measure each deck separately), plus synthetic decks obtained
+# by repeating the content of a reference deck 10 and 100 times (with
+# copies of its markdown files, so that they really get processed again).
+# For each run, it measures wall time, peak RSS, and output size, and
+# compares them with a baseline saved by a previous run (--save).
+# Run it from the slides directory, e.g.: bench/run.py --save
+# The markmaker cache is disabled unless --cache is given.
+
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+import yaml
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+SYNTHETIC = os.path.join("bench", "synthetic")
+OUTDIR = os.path.join(SYNTHETIC, "out")
+
+
+# Run a command, and return (wall time in seconds, peak RSS in KB).
+# os.wait4 gives us the resource usage of that specific child.
+def measure(command, stdout=subprocess.DEVNULL, env=None):
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=stdout, stderr=subprocess.DEVNULL, env=env)
+    pid, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if process.returncode:
+        raise Exception("Command failed with status {}: {}".format(process.returncode, command))
+    # ru_maxrss is in KB on Linux, but in bytes on macOS.
+    maxrss = rusage.ru_maxrss // 1024 if sys.platform == "darwin" else rusage.ru_maxrss
+    return elapsed, maxrss
+
+
+def copyfile(filename, copy):
+    target = os.path.join(SYNTHETIC, str(copy), filename)
+    if not os.path.exists(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        text = open(filename).read()
+        # Make titles unique, so that the TOC and title slides look real.
+        text = re.sub("^# (.*)", r"# \1 ({})".format(copy), text, flags=re.MULTILINE)
+        with open(target, "w") as f:
+            f.write(text)
+    return target
+
+
+def copycontent(content, copy):
+    if isinstance(content, list):
+        return [copycontent(c, copy) for c in content]
+    if isinstance(content, str) and "\n" not in content and os.path.isfile(content):
+        return copyfile(content, copy)
+    return content
+
+
+# Generate a deck with the content of "filename" repeated "scale" times.
+def synthetic(filename, scale):
+    manifest = yaml.safe_load(open(filename))
+    content = []
+    for copy in range(scale):
+        content.extend(copycontent(manifest["content"], copy))
+    manifest["content"] = content
+    manifest["html"] = "{}-x{}.yml.html".format(os.path.basename(filename)[:-4], scale)
+    synthetic_filename = os.path.join(SYNTHETIC, manifest["html"][:-len(".html")])
+    with open(synthetic_filename, "w") as f:
+        yaml.safe_dump(manifest, f)
+    return synthetic_filename
+
+
+def benchdeck(filename, env):
+    # count-slides.py expects the YAML file next to the HTML file.
+    shutil.copy(filename, OUTDIR)
+    html = os.path.join(OUTDIR, os.path.basename(filename) + ".html")
+    with open(html, "w") as f:
+        markmaker_time, markmaker_rss = measure(
+            [sys.executable, "markmaker.py", filename], stdout=f, env=env)
+    count_time, count_rss = measure([sys.executable, "count-slides.py", html], env=env)
+    return dict(
+        markmaker_seconds=markmaker_time,
+        markmaker_maxrss_kb=markmaker_rss,
+        count_slides_seconds=count_time,
+        count_slides_maxrss_kb=count_rss,
+        output_bytes=os.path.getsize(html),
+        )
+
+
+def compare(value, baseline):
+    if not baseline:
+        return ""
+    return "{:+.0%}".format(value / baseline - 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the slides toolchain.")
+    parser.add_argument("decks", metavar="YAML", nargs="*",
+        help="decks to benchmark (default: all *.yml files)")
+    parser.add_argument("--scales", default="10,100",
+        help="scales of the synthetic decks (default: %(default)s; empty to skip them)")
+    parser.add_argument("--reference", default="kube-selfpaced.yml",
+        help="deck used to generate synthetic decks (default: %(default)s)")
+    parser.add_argument("--baseline", default=os.path.join(BENCHDIR, "baseline.json"),
+        help="baseline file (default: %(default)s)")
+    parser.add_argument("--save", action="store_true",
+        help="save the results as the new baseline")
+    parser.add_argument("--output", metavar="FILE",
+        help="also save the results to FILE (as JSON)")
+    parser.add_argument("--cache", action="store_true",
+        help="let markmaker use its cache (it's disabled by default)")
+    args = parser.parse_args()
+
+    env = dict(os.environ, LOG_LEVEL="WARNING")
+    if not args.cache:
+        env["CACHE_DIR"] = ""
+    decks = args.decks or sorted(glob.glob("*.yml"))
+    scales = [int(s) for s in args.scales.split(",") if s]
+
+    os.makedirs(OUTDIR, exist_ok=True)
+    try:
+        results = {}
+        elapsed, maxrss = measure([sys.executable, "index.py"], env=env)
+        results["index.py"] = dict(index_seconds=elapsed, index_maxrss_kb=maxrss)
+        for filename in decks:
+            logging.info("Benchmarking {}...".format(filename))
+            results[filename] = benchdeck(filename, env)
+        for scale in scales:
+            logging.info("Generating and benchmarking {} x{}...".format(args.reference, scale))
+            filename = synthetic(args.reference, scale)
+            results[os.path.basename(filename)] = benchdeck(filename, env)
+    finally:
+        shutil.rmtree(SYNTHETIC, ignore_errors=True)
+        shutil.rmtree(os.path.join("fragments", SYNTHETIC), ignore_errors=True)
+
+    try:
+        baseline = json.load(open(args.baseline))
+    except (OSError, ValueError):
+        logging.info("No baseline found in {}.".format(args.baseline))
+        baseline = {}
+
+    print("{:<28} {:>9} {:>6} {:>9} {:>6} {:>9} {:>6} {:>10}".format(
+        "deck", "markmaker", "", "RSS (MB)", "", "count", "", "output KB"))
+    for name, result in results.items():
+        if name == "index.py":
+            continue
+        base = baseline.get(name, {})
+        print("{:<28} {:>8.3f}s {:>6} {:>9.1f} {:>6} {:>8.3f}s {:>6} {:>10}".format(
+            name,
+            result["markmaker_seconds"],
+            compare(result["markmaker_seconds"], base.get("markmaker_seconds")),
+            result["markmaker_maxrss_kb"] / 1024,
+            compare(result["markmaker_maxrss_kb"], base.get("markmaker_maxrss_kb")),
+            result["count_slides_seconds"],
+            compare(result["count_slides_seconds"], base.get("count_slides_seconds")),
+            result["output_bytes"] // 1024,
+            ))
+    index = results["index.py"]
+    print("index.py: {:.3f}s {}".format(index["index_seconds"], compare(
+        index["index_seconds"], baseline.get("index.py", {}).get("index_seconds"))))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        logging.info("Saved baseline to {}.".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Benchmark the insertion of title slides in a deck: the legacy
+# insertslide (which rebuilds the whole document for each title)
+# against the placeholders recorded by markmaker.processcontent.
+# Usage (from the slides directory): bench/titleslides.py [manifest.yml] [rounds]
+
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING"))
+import markmaker
+from markmaker import all_titles, interstitials
+
+
+def legacy_insertslide(markdown, title):
+    title_position = markdown.find("\n# {}\n".format(title))
+    slide_position = markdown.rfind("\n---\n", 0, title_position+1)
+    before = markdown[:slide_position]
+    _titles_ = [""] + all_titles + [""]
+    currentindex = _titles_.index(title)
+    extra_slide = markmaker.titleslide(
+        title, _titles_[currentindex-1], _titles_[currentindex+1])
+    after = markdown[slide_position:]
+    return before + extra_slide + after
+
+
+def legacy(chunks, titles, toc):
+    markdown = "".join(c for c in chunks if isinstance(c, str))
+    markdown = markdown.replace("@@TOC@@", toc)
+    for title in markmaker.flatten(titles):
+        markdown = legacy_insertslide(markdown, title)
+    return markdown
+
+
+def placeholders(chunks, titles, toc):
+    for chunk in chunks:
+        if isinstance(chunk, markmaker.TitleSlides):
+            del chunk.slides[:]
+    markmaker.inserttitleslides(chunks, titles)
+    markdown = "".join(str(chunk) for chunk in chunks)
+    return markdown.replace("@@TOC@@", toc)
+
+
+def timeit(function, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        interstitials.index = 0
+        markdown = function(chunks, titles, toc)
+    return markdown, (time.perf_counter() - start) / rounds
+
+
+filename = sys.argv[1] if len(sys.argv) > 1 else "kube-selfpaced.yml"
+rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+markmaker.manifest = markmaker.loadmanifest(filename)
+interstitials.load()
+chunks, titles = markmaker.processcontent(markmaker.manifest["content"], filename)
+toc = markmaker.gentoc(titles)
+
+before_markdown, before = timeit(legacy, rounds)
+after_markdown, after = timeit(placeholders, rounds)
+if before_markdown != after_markdown:
+    logging.error("Output mismatch.")
+    sys.exit(1)
+
+print("{}: {} titles, {} bytes of markdown, {} rounds".format(
+    filename, len(list(markmaker.flatten(titles))), len(after_markdown), rounds))
+print("before: {:8.2f} ms/deck".format(1000 * before))
+print("after:  {:8.2f} ms/deck".format(1000 * after))
+print("speedup: {:.1f}x".format(before / after))
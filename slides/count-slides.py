@@ -1,75 +1,142 @@
 #!/usr/bin/env python
+# Count the slides of each section (and part) of generated decks.
+# Usage: count-slides.py [--json] deck.yml[.html] [other-deck.yml[.html]...]
+# If markmaker.py saved slide statistics next to the HTML file (in
+# deck.yml.stats.json) and they are up to date, they are used as-is.
+# Otherwise, the HTML file is read line by line, in a single pass; the YAML
+# manifest (next to it) is only used to know which slide classes are excluded.
+import argparse
+import json
+import os
 import re
 import sys
 import yaml
 
 FIRST_SLIDE_MARKER = "name: toc-"
 PART_PREFIX = "part-"
+TOC_LINK = re.compile("\(#toc-(.*)\)")
 
-filename = sys.argv[1]
-if filename.endswith(".html"):
-    html_file = filename
-    yaml_file = filename[: -len(".html")]
-else:
-    html_file = filename + ".html"
-    yaml_file = filename
-excluded_classes = yaml.safe_load(open(yaml_file))["exclude"]
 
+class Counter(object):
 
-class State(object):
-    def __init__(self):
+    def __init__(self, excluded_classes):
+        self.excluded_classes = set(excluded_classes)
+        self.slides = 0
+        self.excluded = 0
+        self.subslides = 0
         self.current_slide = -1
+        self.sections = []
         self.parts = {}
+        self.section = None
+        self.new_section(None, [])
+        self.slide = []
 
-    def end_section(self):
-        if state.section_title:
-            print(
-                "{0.section_start}\t{0.section_slides}\t{0.section_title}".format(self)
-            )
-        if self.section_part:
-            if self.section_part not in self.parts:
-                self.parts[self.section_part] = 0
-            self.parts[self.section_part] += self.section_slides
-
-    def new_section(self, slide):
-        # Normally, the title should be prefixed by a space
-        # (because section titles are first-level titles in markdown,
-        # e.g. "# Introduction", and markmaker removes the # but leaves
-        # the leading space).
-        self.section_title = None
-        if "\n " in slide:
-            self.section_title = slide.split("\n ")[1].split("\n")[0]
-        toc_links = re.findall("\(#toc-(.*)\)", slide)
-        self.section_part = None
+    # Feed the lines of the HTML file one at a time.
+    # Only the current slide is kept in memory.
+    def feed(self, line):
+        if line == "---\n" and self.slide:
+            self.end_slide()
+            self.slide = []
+        else:
+            self.slide.append(line)
+
+    def end_slide(self):
+        # Slides were separated by "\n---\n"; drop the "\n" before "---".
+        slide = "".join(self.slide)
+        if slide.endswith("\n"):
+            slide = slide[:-1]
+        subslides = len(slide.split("\n--\n"))
+        self.slides += 1
+        self.subslides += subslides
+        for line in slide.split("\n"):
+            if line.startswith("class:") and self.excluded_classes.intersection(line.split()):
+                self.excluded += 1
+                self.section["excluded"] += 1
+                return
+        if FIRST_SLIDE_MARKER in slide:
+            # A new section starts. Record info about the part that just ended.
+            self.end_section()
+            # Normally, the title should be prefixed by a space
+            # (because section titles are first-level titles in markdown,
+            # e.g. "# Introduction", and markmaker removes the # but leaves
+            # the leading space).
+            title = slide.split("\n ")[1].split("\n")[0] if "\n " in slide else None
+            self.new_section(title, TOC_LINK.findall(slide))
+        self.section["size"] += 1
+        self.section["subslides"] += subslides
+        self.current_slide += subslides
+
+    def new_section(self, title, toc_links):
+        part = None
         for toc_link in toc_links:
             if toc_link.startswith(PART_PREFIX):
-                self.section_part = toc_link
-        self.section_start = self.current_slide
-        self.section_slides = 0
-
-
-state = State()
-state.new_section("")
-print("{}\t{}\t{}".format("index", "size", "title"))
-
-for slide in open(html_file).read().split("\n---\n"):
-    excluded = False
-    for line in slide.split("\n"):
-        if line.startswith("class:"):
-            for klass in excluded_classes:
-                if klass in line.split():
-                    excluded = True
-    if excluded:
-        continue
-    if FIRST_SLIDE_MARKER in slide:
-        # A new section starts. Show info about the part that just ended.
-        state.end_section()
-        state.new_section(slide)
-    state.section_slides += 1
-    for sub_slide in slide.split("\n--\n"):
-        state.current_slide += 1
-else:
-    state.end_section()
+                part = toc_link
+        self.section = dict(index=self.current_slide, size=0, subslides=0,
+                            excluded=0, title=title, part=part)
+
+    def end_section(self):
+        if self.section["title"]:
+            self.sections.append(self.section)
+        part = self.section["part"]
+        if part:
+            self.parts.setdefault(part, dict(part=part, size=0, subslides=0, excluded=0))
+            for k in ["size", "subslides", "excluded"]:
+                self.parts[part][k] += self.section[k]
+
+    # Same format as the statistics saved by markmaker.py.
+    def finish(self):
+        self.end_slide()
+        self.end_section()
+        return dict(
+            slides=self.slides,
+            excluded=self.excluded,
+            subslides=self.subslides,
+            sections=self.sections,
+            parts=[self.parts[part] for part in
+                   sorted(self.parts, key=lambda p: int(p.split("-")[1]))],
+        )
 
-for part in sorted(state.parts, key=lambda f: int(f.split("-")[1])):
-    print("{}\t{}\t{}".format(0, state.parts[part], "total size for " + part))
+
+def count(filename):
+    if filename.endswith(".html"):
+        html_file = filename
+        yaml_file = filename[: -len(".html")]
+    else:
+        html_file = filename + ".html"
+        yaml_file = filename
+    stats_file = yaml_file + ".stats.json"
+    if os.path.exists(stats_file) and os.path.getmtime(stats_file) >= os.path.getmtime(html_file):
+        return json.load(open(stats_file))
+    excluded_classes = yaml.safe_load(open(yaml_file))["exclude"]
+    counter = Counter(excluded_classes)
+    with open(html_file) as f:
+        for line in f:
+            counter.feed(line)
+    return counter.finish()
+
+
+def show(counts):
+    print("{}\t{}\t{}".format("index", "size", "title"))
+    for section in counts["sections"]:
+        print("{index}\t{size}\t{title}".format(**section))
+    for part in counts["parts"]:
+        print("{}\t{}\t{}".format(0, part["size"], "total size for " + part["part"]))
+
+
+parser = argparse.ArgumentParser(
+    description="Count the slides in each section and part of generated decks.")
+parser.add_argument("decks", metavar="DECK", nargs="+",
+    help="YAML manifest or generated HTML file")
+parser.add_argument("--json", action="store_true",
+    help="output JSON (with the counts of all decks) instead of tab-separated values")
+args = parser.parse_args()
+
+results = {deck: count(deck) for deck in args.decks}
+if args.json:
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+else:
+    for deck in args.decks:
+        if len(args.decks) > 1:
+            print("==> {} <==".format(deck))
+        show(results[deck])
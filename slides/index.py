@@ -138,11 +138,23 @@ TEMPLATE="""<html>
 </body>
 </html>"""
 
+import argparse
 import datetime
 import jinja2
 import yaml
 
-items = yaml.safe_load(open("index.yaml"))
+from profiling import profile
+
+parser = argparse.ArgumentParser(
+    description="Generate index.html and past.html from index.yaml.")
+parser.add_argument("--profile", metavar="FILE",
+    help="record how long each phase takes; save that to FILE (as JSON) "
+         "and show a summary on stderr")
+args = parser.parse_args()
+profile.enabled = bool(args.profile)
+
+with profile.phase("index load"):
+    items = yaml.safe_load(open("index.yaml"))
 
 
 def prettyparse(date):
@@ -166,42 +178,44 @@ def prettyparse(date):
 # The event will be considered "current" (shown in the list of
 # upcoming events) until the second date.
 
-for item in items:
-    if "date" in item:
-        date = item["date"]
-        if type(date) == list:
-            date_begin, date_end = date
-        else:
-            date_begin, date_end = date, date
-        y1, m1, d1 = prettyparse(date_begin)
-        y2, m2, d2 = prettyparse(date_end)
-        if (y1, m1, d1) == (y2, m2, d2):
-            # Single day event
-            pretty_date = "{} {}, {}".format(m1, d1, y1)
-        elif (y1, m1) == (y2, m2):
-            # Multi-day event within a single month
-            pretty_date = "{} {}-{}, {}".format(m1, d1, d2, y1)
-        elif y1 == y2:
-            # Multi-day event spanning more than a month
-            pretty_date = "{} {}-{} {}, {}".format(m1, d1, m2, d2, y1)
-        else:
-            # Event spanning the turn of the year (REALLY???)
-            pretty_date = "{} {}, {}-{} {}, {}".format(m1, d1, y1, m2, d2, y2)
-        item["begin"] = date_begin
-        item["end"] = date_end
-        item["prettydate"] = pretty_date
-    item["flag"] = FLAGS.get(item.get("country"),"")
-
-today = datetime.date.today()
-coming_soon = [i for i in items if i.get("date") and i["end"] >= today]
-coming_soon.sort(key=lambda i: i["begin"])
-past_workshops = [i for i in items if i.get("date") and i["end"] < today]
-past_workshops.sort(key=lambda i: i["begin"], reverse=True)
-self_paced = [i for i in items if not i.get("date")]
-recorded_workshops = [i for i in items if i.get("video")]
-
-template = jinja2.Template(TEMPLATE)
-with open("index.html", "w") as f:
+with profile.phase("items processing"):
+    for item in items:
+        if "date" in item:
+            date = item["date"]
+            if type(date) == list:
+                date_begin, date_end = date
+            else:
+                date_begin, date_end = date, date
+            y1, m1, d1 = prettyparse(date_begin)
+            y2, m2, d2 = prettyparse(date_end)
+            if (y1, m1, d1) == (y2, m2, d2):
+                # Single day event
+                pretty_date = "{} {}, {}".format(m1, d1, y1)
+            elif (y1, m1) == (y2, m2):
+                # Multi-day event within a single month
+                pretty_date = "{} {}-{}, {}".format(m1, d1, d2, y1)
+            elif y1 == y2:
+                # Multi-day event spanning more than a month
+                pretty_date = "{} {}-{} {}, {}".format(m1, d1, m2, d2, y1)
+            else:
+                # Event spanning the turn of the year (REALLY???)
+                pretty_date = "{} {}, {}-{} {}, {}".format(m1, d1, y1, m2, d2, y2)
+            item["begin"] = date_begin
+            item["end"] = date_end
+            item["prettydate"] = pretty_date
+        item["flag"] = FLAGS.get(item.get("country"),"")
+
+    today = datetime.date.today()
+    coming_soon = [i for i in items if i.get("date") and i["end"] >= today]
+    coming_soon.sort(key=lambda i: i["begin"])
+    past_workshops = [i for i in items if i.get("date") and i["end"] < today]
+    past_workshops.sort(key=lambda i: i["begin"], reverse=True)
+    self_paced = [i for i in items if not i.get("date")]
+    recorded_workshops = [i for i in items if i.get("video")]
+
+with profile.phase("template compilation"):
+    template = jinja2.Template(TEMPLATE)
+with profile.phase("index.html render"), open("index.html", "w") as f:
     f.write(template.render(
     	title="Container Training",
     	coming_soon=coming_soon,
@@ -210,8 +224,11 @@ with open("index.html", "w") as f:
     	recorded_workshops=recorded_workshops
     	))
 
-with open("past.html", "w") as f:
+with profile.phase("past.html render"), open("past.html", "w") as f:
 	f.write(template.render(
 		title="Container Training",
 		all_past_workshops=past_workshops
 		))
+
+if args.profile:
+    profile.report(args.profile)
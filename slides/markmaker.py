@@ -1,15 +1,25 @@
 #!/usr/bin/env python3
 # transforms a YAML manifest into a HTML workshop file
 
+import argparse
+import collections
+import concurrent.futures
 import glob
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import re
 import string
 import subprocess
 import sys
+import threading
+import time
 import yaml
 
+from profiling import profile
+
 
 logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
 
@@ -20,11 +30,18 @@ def anchor(title):
     return "toc-" + title
 
 
+# Images shown before each title slide. They are (re)loaded before each
+# deck (see builddeck), since interstitials.txt can change with --watch.
 class Interstitials(object):
 
     def __init__(self):
         self.index = 0
-        self.images = [url.strip() for url in open("interstitials.txt") if url.strip()]
+        self.images = []
+
+    def load(self):
+        self.index = 0
+        self.images = [url.strip() for url in readsource("interstitials.txt").split("\n")
+                       if url.strip()]
 
     def next(self):
         index = self.index % len(self.images)
@@ -35,21 +52,26 @@ class Interstitials(object):
 interstitials = Interstitials()
 
 
-def insertslide(markdown, title):
-    title_position = markdown.find("\n# {}\n".format(title))
-    slide_position = markdown.rfind("\n---\n", 0, title_position+1)
-    logging.debug("Inserting title slide at position {}: {}".format(slide_position, title))
+# Placeholder for automatically generated title slides, in the list of
+# markdown chunks returned by processcontent. Placeholders are located
+# right before the separator ("\n---\n") of the slide showing their titles.
+class TitleSlides(object):
+
+    def __init__(self):
+        self.titles = []
+        self.slides = []
+
+    def __str__(self):
+        return "".join(self.slides)
 
-    before = markdown[:slide_position]
 
+def titleslide(title, previoustitle, nexttitle):
     toclink = "toc-part-{}".format(title2part[title])
-    _titles_ = [""] + all_titles + [""]
-    currentindex = _titles_.index(title)
-    previouslink = anchor(_titles_[currentindex-1])
-    nextlink = anchor(_titles_[currentindex+1])
+    previouslink = anchor(previoustitle)
+    nextlink = anchor(nexttitle)
     interstitial = interstitials.next()
 
-    extra_slide = """
+    return """
 ---
 
 class: pic
@@ -73,8 +95,202 @@ class: title
 
 .debug[(automatically generated title slide)]
 """.format(anchor=anchor(title), interstitial=interstitial, title=title, toclink=toclink, previouslink=previouslink, nextlink=nextlink)
-    after = markdown[slide_position:]
-    return before + extra_slide + after
+
+
+# Generate the title slides, and put them in their placeholders.
+# If a title shows up multiple times, all its title slides go
+# before its first occurrence.
+def inserttitleslides(chunks, titles):
+    placeholders = {}
+    for chunk in chunks:
+        if isinstance(chunk, TitleSlides):
+            for title in chunk.titles:
+                placeholders.setdefault(title, chunk)
+    _titles_ = [""] + all_titles + [""]
+    titleindex = {}
+    for i, title in enumerate(_titles_):
+        titleindex.setdefault(title, i)
+    for title in flatten(titles):
+        if title not in placeholders:
+            logging.warning("Could not find where to insert title slide: {}".format(title))
+            continue
+        logging.debug("Inserting title slide: {}".format(title))
+        currentindex = titleindex[title]
+        placeholders[title].slides.append(titleslide(
+            title, _titles_[currentindex-1], _titles_[currentindex+1]))
+
+
+# Split a markdown fragment at the beginning of each slide showing one
+# of the given titles, and put a TitleSlides placeholder there.
+# Returns the list of chunks.
+def splittitles(markdown, titles):
+    placeholders = {}
+    for title in titles:
+        # Offsets are shifted by one, since the title can be on the
+        # first line of the fragment (just after a separator).
+        title_position = ("\n" + markdown).find("\n# {}\n".format(title))
+        if title_position < 0:
+            continue
+        # -1 means "before the separator preceding this fragment"
+        slide_position = markdown.rfind("\n---\n", 0, title_position)
+        placeholders.setdefault(slide_position, TitleSlides()).titles.append(title)
+    chunks = []
+    start = 0
+    for slide_position in sorted(placeholders):
+        if slide_position >= 0:
+            chunks.append(markdown[start:slide_position])
+            start = slide_position
+        chunks.append(placeholders[slide_position])
+    chunks.append(markdown[start:])
+    return chunks
+
+
+# Statistics about the slides of a deck: how many slides (and sub-slides,
+# i.e. "--" increments) in each section and each part, and how many were
+# excluded. They are computed while the deck is written (the output is
+# fed to SlideStats chunk by chunk), and follow the same rules as
+# count-slides.py: sections start on slides anchored with "name: toc-..."
+# (title slides and TOC slides), and the "index" of a section is the
+# remark slide number (minus one) of its title slide.
+class SlideStats(object):
+
+    def __init__(self, exclude):
+        self.exclude = set(exclude)
+        self.pending = ""
+        self.slides = 0
+        self.excluded = 0
+        self.subslides = 0
+        self.current_slide = -1
+        self.sections = []
+        self.parts = {}
+        self.newsection(None, None)
+        self.anchors = {anchor(title): title for title in all_titles}
+
+    def feed(self, markdown):
+        slides = (self.pending + markdown).split("\n---\n")
+        self.pending = slides.pop()
+        for slide in slides:
+            self.addslide(slide)
+
+    def addslide(self, slide):
+        subslides = slide.count("\n--\n") + 1
+        self.slides += 1
+        self.subslides += subslides
+        for line in slide.split("\n"):
+            if line.startswith("class:") and self.exclude.intersection(line.split()):
+                self.excluded += 1
+                self.section["excluded"] += 1
+                return
+        names = re.findall("^name: (toc-.*)", slide, re.MULTILINE)
+        if names:
+            self.endsection()
+            title = self.anchors.get(names[0])
+            part = "part-{}".format(title2part[title]) if title in title2part else None
+            self.newsection(title, part)
+        self.section["size"] += 1
+        self.section["subslides"] += subslides
+        self.current_slide += subslides
+
+    def newsection(self, title, part):
+        self.section = dict(index=self.current_slide, size=0, subslides=0,
+                            excluded=0, title=title, part=part)
+
+    def endsection(self):
+        if self.section["title"]:
+            self.sections.append(self.section)
+        part = self.section["part"]
+        if part:
+            self.parts.setdefault(part, dict(part=part, size=0, subslides=0, excluded=0))
+            for k in ["size", "subslides", "excluded"]:
+                self.parts[part][k] += self.section[k]
+
+    def finish(self):
+        self.addslide(self.pending)
+        self.pending = ""
+        self.endsection()
+        return dict(
+            slides=self.slides,
+            excluded=self.excluded,
+            subslides=self.subslides,
+            sections=self.sections,
+            parts=[self.parts[part] for part in
+                   sorted(self.parts, key=lambda p: int(p.split("-")[1]))],
+            )
+
+
+# Index of the slides of a deck, for autopilot/autotest.py (so that it
+# doesn't have to parse the HTML file when it starts). It follows the
+# rules that autotest.py uses on HTML files: slides are split on "---"
+# and "--" (since each increment gets its own slide number), slides with
+# an excluded class are skipped, speaker notes (after "???") are dropped,
+# and snippets are the ``` blocks within .lab[] (or .exercise[]) sections.
+# The index doesn't have the text of the slides (that would make it about
+# as big as the deck): slides are given by their offsets in the HTML file,
+# and snippets by their offsets in their slide, so autotest.py needs the
+# HTML file next to the index ("length" is the size of the HTML file, in
+# characters, to check that they match).
+# "next" is the index of the next snippet of the same exercise.
+# Each slide also has the number of the part of the TOC that it's in
+# (starting at its title slide), or None for the slides before the first
+# part; autotest.py uses that to split decks when testing in parallel.
+class SlideIndex(object):
+
+    separator = re.compile("\n---?\n")
+
+    def __init__(self, exclude):
+        self.exclude = list(exclude)
+        self.pending = ""
+        self.position = 0
+        self.slides = []
+        self.part = None
+        self.anchors = {anchor(title): title for title in all_titles}
+
+    def feed(self, text):
+        self.pending += text
+        start = 0
+        for match in self.separator.finditer(self.pending):
+            # "\n--\n" at the very end could be the beginning of "\n---\n".
+            if match.end() == len(self.pending):
+                break
+            self.addslide(self.pending[start:match.start()], self.position + start)
+            start = match.end()
+        self.pending = self.pending[start:]
+        self.position += start
+
+    # "position" is the offset of the slide in the HTML file.
+    def addslide(self, slide, position):
+        classes = re.findall("class: (.*)", slide)
+        if classes and set(self.exclude).intersection(c.strip() for c in classes[0].split(",")):
+            return
+        for name in re.findall("^name: (toc-.*)", slide, re.MULTILINE):
+            title = self.anchors.get(name)
+            if title in title2part:
+                self.part = title2part[title]
+        content = re.split("\n\?\?\?\n", slide)[0]
+        snippets = []
+        exercises_without_snippets = 0
+        for match in re.finditer("\.(?:exercise|lab)\[(.*)\]", content, re.DOTALL):
+            exercise = match.group(1)
+            if "```" not in exercise:
+                exercises_without_snippets += 1
+                continue
+            start = match.start(1)
+            for i, chunk in enumerate(exercise.split("```")):
+                end = start + len(chunk)
+                if i % 2 == 1:
+                    if i > 1:
+                        snippets[-1]["next"] = len(snippets)
+                    snippets.append(dict(start=start, end=end, next=None))
+                start = end + len("```")
+        self.slides.append(dict(start=position, end=position + len(content),
+                                snippets=snippets, part=self.part,
+                                exercises_without_snippets=exercises_without_snippets))
+
+    def finish(self):
+        self.addslide(self.pending, self.position)
+        self.position += len(self.pending)
+        self.pending = ""
+        return dict(excluded_classes=self.exclude, length=self.position, slides=self.slides)
 
 
 def flatten(titles):
@@ -86,54 +302,271 @@ def flatten(titles):
             yield title
 
 
-def generatefromyaml(manifest, filename):
-    markdown, titles = processcontent(manifest["content"], filename)
+# Split the HTML template at its @@-strings.
+# Returns a list alternating between HTML snippets and @@-strings.
+# The result is kept around until workshop.html changes.
+_template = (None, None)
+
+def splittemplate():
+    global _template
+    text = readsource("workshop.html")
+    if _template[0] is not text:
+        _template = (text, re.split("(@@[A-Z]+@@)", text))
+    return _template[1]
+
+
+# Generate a deck, and write it to "out" (a file object) as we go,
+# so that we never hold the whole deck in memory.
+# Returns the sidecar files of the deck, as a dict mapping their kind
+# to their content: "stats" (see SlideStats) and "slides" (see SlideIndex).
+def generatefromyaml(manifest, filename, out):
+    # Load, expand, and save the markdown files in parallel;
+    # processcontent will then pick up the results in order.
+    with concurrent.futures.ThreadPoolExecutor(fragment_threads) as executor:
+        fragments = {contentfile: executor.submit(processfile, contentfile)
+                     for contentfile in contentfiles(manifest["content"])}
+        chunks, titles = processcontent(manifest["content"], filename, fragments)
     logging.debug("Found {} titles.".format(len(titles)))
-    toc = gentoc(titles)
-    markdown = markdown.replace("@@TOC@@", toc)
-    for title in flatten(titles):
-        markdown = insertslide(markdown, title)
+    with profile.phase("toc generation"):
+        toc = gentoc(titles)
+    with profile.phase("title insertion"):
+        inserttitleslides(chunks, titles)
 
     exclude = manifest.get("exclude", [])
     logging.debug("exclude={!r}".format(exclude))
     if not exclude:
         logging.warning("'exclude' is empty.")
+    stats = SlideStats(exclude)
+    index = SlideIndex(exclude)
     exclude = ",".join('"{}"'.format(c) for c in exclude)
 
     # Insert build info. This is super hackish.
-    markdown = markdown.replace(
-        ".debug[",
-        ".debug[\n```\n{}\n```\n\nThese slides have been built from commit: {}\n\n".format(dirtyfiles, commit),
-        1)
-
-    html = open("workshop.html").read()
-    html = html.replace("@@TITLE@@", manifest["title"].replace("\n", " "))
-    html = html.replace("@@MARKDOWN@@", markdown)
-    html = html.replace("@@EXCLUDE@@", exclude)
-    html = html.replace("@@SLIDENUMBERPREFIX@@", manifest.get("slidenumberprefix", ""))
-    return html
-
-def processAtAtStrings(text):
-    text = text.replace("@@CHAT@@", manifest["chat"])
-    text = text.replace("@@GITREPO@@", manifest["gitrepo"])
-    text = text.replace("@@SLIDES@@", manifest["slides"])
-    text = text.replace("@@ZIP@@", manifest["zip"])
-    text = text.replace("@@HTML@@", manifest["html"])
-    text = text.replace("@@TITLE@@", manifest["title"].replace("\n", "<br/>"))
-    # Process @@LINK[file] and @@INCLUDE[file] directives
-    local_anchor_path = ".."
-    # FIXME use dynamic repo and branch?
-    online_anchor_path = "https://github.com/jpetazzo/container.training/tree/main"
-    for atatlink in re.findall(r"@@LINK\[[^]]*\]", text):
-        logging.debug("Processing {}".format(atatlink))
-        file_name = atatlink[len("@@LINK["):-1]
-        text = text.replace(atatlink, "[{}]({}/{})".format(file_name, online_anchor_path, file_name ))
-    for atatinclude in re.findall(r"@@INCLUDE\[[^]]*\]", text):
-        logging.debug("Processing {}".format(atatinclude))
-        file_name = atatinclude[len("@@INCLUDE["):-1]
-        file_path = os.path.join(local_anchor_path, file_name)
-        text = text.replace(atatinclude, open(file_path).read())
-    return text
+    buildinfo = ".debug[\n```\n{}\n```\n\nThese slides have been built from commit: {}\n\n".format(
+        gitinfo()["dirtyfiles"], gitinfo()["commit"])
+
+    def writemarkdown():
+        inserted_buildinfo = False
+        for chunk in chunks:
+            chunk = str(chunk)
+            if "@@TOC@@" in chunk:
+                chunk = chunk.replace("@@TOC@@", toc)
+            if not inserted_buildinfo and ".debug[" in chunk:
+                chunk = chunk.replace(".debug[", buildinfo, 1)
+                inserted_buildinfo = True
+            stats.feed(chunk)
+            index.feed(chunk)
+            out.write(chunk)
+
+    values = {
+        "@@TITLE@@": manifest["title"].replace("\n", " "),
+        "@@EXCLUDE@@": exclude,
+        "@@SLIDENUMBERPREFIX@@": manifest.get("slidenumberprefix", ""),
+    }
+    template = splittemplate()
+    with profile.phase("html write"):
+        for piece in template:
+            if piece == "@@MARKDOWN@@":
+                writemarkdown()
+            else:
+                piece = values.get(piece, piece)
+                stats.feed(piece)
+                index.feed(piece)
+                out.write(piece)
+    return dict(stats=stats.finish(), slides=index.finish())
+
+# @@-strings and @@-directives that can be used in markdown files.
+# "@@FOO@@" is replaced with atat_strings["FOO"](manifest).
+# "@@FOO[bar]" is replaced with atat_directives["FOO"]("bar").
+# Anything else that looks like an @@-string (e.g. @@TOC@@, which is
+# handled later in generatefromyaml) is left untouched.
+atat_strings = {
+    "CHAT": lambda manifest: manifest["chat"],
+    "GITREPO": lambda manifest: manifest["gitrepo"],
+    "SLIDES": lambda manifest: manifest["slides"],
+    "ZIP": lambda manifest: manifest["zip"],
+    "HTML": lambda manifest: manifest["html"],
+    "TITLE": lambda manifest: manifest["title"].replace("\n", "<br/>"),
+}
+
+# Used by @@LINK[file] and @@INCLUDE[file]
+local_anchor_path = ".."
+# FIXME use dynamic repo and branch?
+online_anchor_path = "https://github.com/jpetazzo/container.training/tree/main"
+
+def atat_link(file_name):
+    return "[{}]({}/{})".format(file_name, online_anchor_path, file_name)
+
+# Resolves @@INCLUDE[file] directives. Included files can include other
+# files (but not themselves, directly or indirectly). The content of
+# included files is kept in a small LRU cache, keyed by path and mtime,
+# since the same files tend to be included by multiple decks.
+class IncludeResolver(object):
+
+    include_regex = re.compile(r"@@INCLUDE\[([^]]*)\]")
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.files = collections.OrderedDict()
+        self.bytes_from_cache = 0
+        self.bytes_from_disk = 0
+        self.missing = set()
+        self.lock = threading.Lock()
+
+    def read(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            if path in self.files and self.files[path][0] == mtime:
+                self.files.move_to_end(path)
+                content = self.files[path][1]
+                self.bytes_from_cache += len(content)
+                return content
+        content = open(path).read()
+        with self.lock:
+            self.files[path] = (mtime, content)
+            self.files.move_to_end(path)
+            while len(self.files) > self.maxsize:
+                self.files.popitem(last=False)
+            self.bytes_from_disk += len(content)
+        return content
+
+    def path(self, file_name):
+        return os.path.normpath(os.path.join(local_anchor_path, file_name))
+
+    def resolve(self, file_name, stack=()):
+        path = self.path(file_name)
+        if path in stack:
+            raise ValueError("@@INCLUDE loop: {}".format(" -> ".join(stack + (path,))))
+        content = self.read(path)
+        if "@@INCLUDE[" not in content:
+            return content
+        return self.include_regex.sub(
+            lambda match: self.resolve(match.group(1), stack + (path,)), content)
+
+    # Paths of all the files included by a text (directly or not).
+    # Missing files are listed too (so that --watch rebuilds the deck when
+    # they show up); resolve() is the one reporting them as errors.
+    def dependencies(self, text, seen=None):
+        if seen is None:
+            seen = []
+        for file_name in self.include_regex.findall(text):
+            path = self.path(file_name)
+            if path not in seen:
+                seen.append(path)
+                try:
+                    content = self.read(path)
+                except OSError as e:
+                    if path not in self.missing:
+                        self.missing.add(path)
+                        logging.warning("Could not read included file: {}".format(e))
+                    continue
+                self.dependencies(content, seen)
+        return seen
+
+
+includes = IncludeResolver()
+
+def atat_include(file_name):
+    return includes.resolve(file_name)
+
+atat_directives = {
+    "LINK": atat_link,
+    "INCLUDE": atat_include,
+}
+
+atat_regex = re.compile(r"@@(?:([A-Z]+)@@|([A-Z]+)\[([^]]*)\])")
+
+def expandAtAt(match):
+    string, directive, argument = match.groups()
+    if string in atat_strings:
+        return atat_strings[string](manifest)
+    if directive in atat_directives:
+        logging.debug("Processing {}".format(match.group(0)))
+        return atat_directives[directive](argument)
+    return match.group(0)
+
+# Expand all @@-strings and @@-directives in a single scan of the text.
+# Expanded values are not scanned again (so e.g. an included file
+# is inserted verbatim).
+# If "used" is a dict, it gets populated with the @@-strings found in
+# the text, mapped to a digest of their expansion (that's what the build
+# cache uses to check that a cached fragment is still valid).
+def processAtAtStrings(text, used=None):
+    def expand(match):
+        expansion = expandAtAt(match)
+        if used is not None:
+            used[match.group(0)] = digest(expansion)
+        return expansion
+    return atat_regex.sub(expand, text)
+
+
+def digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# On-disk cache of expanded markdown files.
+# There is one entry per source file (so the cache doesn't grow each time
+# a file is edited). Since the expansion depends on the content of the
+# file, on the manifest (@@TITLE@@ etc.) and on included files
+# (@@INCLUDE[...]), each entry holds a few variants (the most recently
+# used first); each variant records a digest of the source, and the
+# @@-strings that it used, with a digest of their expansion. A variant
+# is valid if the source is the same, and all these @@-strings still
+# expand to the same thing.
+# Set CACHE_DIR to an empty string to disable the cache.
+class Cache(object):
+
+    version = 2
+    max_variants = 16
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def path(self, filename):
+        key = digest("{}\0{}".format(self.version, filename))
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def variants(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def get(self, filename, source):
+        if not self.directory:
+            return None
+        source_digest = digest(source)
+        for variant in self.variants(self.path(filename)):
+            if variant["source"] != source_digest:
+                continue
+            if all(digest(expandAtAt(atat_regex.fullmatch(atat))) == expansion_digest
+                   for atat, expansion_digest in variant["used"].items()):
+                with self.lock:
+                    self.hits += 1
+                return variant["markdown"], variant["titles"]
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, filename, source, used, markdown, titles):
+        if not self.directory:
+            return
+        path = self.path(filename)
+        variant = dict(source=digest(source), used=used, markdown=markdown, titles=titles)
+        variants = [variant] + self.variants(path)[:self.max_variants-1]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so that concurrent builds
+        # never see a partially written entry.
+        tmp = "{}.{}".format(path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(variants, f)
+        os.replace(tmp, path)
+
+
+cache = Cache(os.environ.get("CACHE_DIR", ".markmaker-cache"))
 
 
 # Maps a title (the string just after "^# ") to its position in the TOC
@@ -182,84 +615,251 @@ def gentoc(tree):
 #   to be recursively loaded and parsed
 # - `filename` is the name of the file that we're currently processing
 #   (to generate inline comments to facilitate edition)
-# Returns: (epxandedmarkdown,[list of titles])
+# - `fragments` maps file names to futures returning the result of
+#   processfile (if a file isn't there, it is processed right away)
+# Returns: ([list of chunks],[list of titles])
+# The chunks are expanded markdown strings, and TitleSlides placeholders
+# (where the title slides will be inserted by inserttitleslides).
+# Joining them gives the markdown of the whole deck.
 # The list of titles can be nested.
-def processcontent(content, filename):
+def processcontent(content, filename, fragments=None):
     if isinstance(content, str):
         if "\n" in content:
             titles = re.findall("^# (.*)", content, re.MULTILINE)
-            slidefooter = ".debug[{}]".format(makelink(filename))
-            content = content.replace("\n---\n", "\n{}\n---\n".format(slidefooter))
-            content += "\n" + slidefooter
-            return (content, titles)
+            return (finishfragment(content, titles, filename), titles)
         if os.path.isfile(content):
-            markdown = open(content).read()
-            markdown = processAtAtStrings(markdown)
-            fragmentfile = os.path.join("fragments", content)
-            fragmentdir = os.path.dirname(fragmentfile)
-            os.makedirs(fragmentdir, exist_ok=True)
-            with open(fragmentfile, "w") as f:
-                f.write(markdown)
-            return processcontent(markdown, content)
+            if fragments and content in fragments:
+                markdown, titles = fragments[content].result()
+            else:
+                markdown, titles = processfile(content)
+            return (finishfragment(markdown, titles, content), titles)
         logging.warning("Content spans only one line (it's probably a file name) but no file found: {}".format(content))
     if isinstance(content, list):
-        subparts = [processcontent(c, filename) for c in content]
-        markdown = "\n---\n".join(c[0] for c in subparts)
-        titles = [t for (m,t) in subparts if t]
-        return (markdown, titles)
+        subparts = [processcontent(c, filename, fragments) for c in content]
+        chunks = []
+        for i, (subchunks, subtitles) in enumerate(subparts):
+            if i > 0:
+                # Title slides for the first slide of this subpart
+                # go before the separator.
+                leading = 0
+                while leading < len(subchunks) and isinstance(subchunks[leading], TitleSlides):
+                    leading += 1
+                chunks.extend(subchunks[:leading])
+                chunks.append("\n---\n")
+                subchunks = subchunks[leading:]
+            chunks.extend(subchunks)
+        titles = [t for (c,t) in subparts if t]
+        return (chunks, titles)
     logging.warning("Invalid content: {}".format(content))
-    return "```\nInvalid content: {}\n```\n".format(content), []
+    return ["```\nInvalid content: {}\n```\n".format(content)], []
 
-# Try to figure out the URL of the repo on GitHub.
-# This is used to generate "edit me on GitHub"-style links.
-try:
-    if "REPOSITORY_URL" in os.environ:
-        repo = os.environ["REPOSITORY_URL"]
-    else:
-        repo = subprocess.check_output(["git", "config", "remote.origin.url"]).decode("ascii")
-    repo = repo.strip().replace("git@github.com:", "https://github.com/")
-    if "BRANCH" in os.environ:
-        branch = os.environ["BRANCH"]
-    else:
-        branch = subprocess.check_output(["git", "rev-parse", "--abbrev-ref", "HEAD"]).decode("ascii")
-        branch = branch.strip()
-    base = subprocess.check_output(["git", "rev-parse", "--show-prefix"]).decode("ascii")
-    base = base.strip().strip("/")
-    urltemplate = ("{repo}/tree/{branch}/{base}/{filename}"
-        .format(repo=repo, branch=branch, base=base, filename="{}"))
-except:
-    logging.exception("Could not generate repository URL; generating local URLs instead.")
-    urltemplate = "file://{pwd}/{filename}".format(pwd=os.environ["PWD"], filename="{}")
-try:
-    commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).decode("ascii")
-except:
-    logging.exception("Could not figure out HEAD commit.")
-    commit = "??????"
-try:
-    dirtyfiles = subprocess.check_output(["git", "status", "--porcelain"]).decode("ascii")
-except:
-    logging.exception("Could not figure out repository cleanliness.")
-    dirtyfiles = "?? git status --porcelain failed"
+# Markdown files, indexed by file name.
+# When building multiple decks, each file is only read once.
+sources = {}
+
+def readsource(filename):
+    if filename not in sources:
+        with profile.phase("fragment read", filename):
+            sources[filename] = open(filename).read()
+    return sources[filename]
+
+# Yield the names of the files referenced by the "content" of a manifest.
+def contentfiles(content):
+    if isinstance(content, str):
+        if "\n" not in content and os.path.isfile(content):
+            yield content
+    elif isinstance(content, list):
+        for c in content:
+            yield from contentfiles(c)
+
+# How many markdown files to process in parallel (in threads).
+fragment_threads = 8
+
+# Load a markdown file, expand its @@-strings (or get it from the cache),
+# and write the result to the "fragments" directory.
+# Returns: (expandedmarkdown,[list of titles])
+# This runs in a thread pool (see generatefromyaml).
+def processfile(filename):
+    source = readsource(filename)
+    with profile.phase("directive expansion", filename):
+        cached = cache.get(filename, source)
+        if cached:
+            markdown, titles = cached
+        else:
+            used = {}
+            markdown = processAtAtStrings(source, used)
+            titles = re.findall("^# (.*)", markdown, re.MULTILINE)
+            cache.put(filename, source, used, markdown, titles)
+    with profile.phase("fragment write", filename):
+        writefragment(filename, markdown)
+    return markdown, titles
+
+# Save an expanded markdown file in the "fragments" directory,
+# unless it's already there with the same content.
+def writefragment(filename, markdown):
+    fragmentfile = os.path.join("fragments", filename)
+    try:
+        with open(fragmentfile) as f:
+            if f.read() == markdown:
+                return
+    except OSError:
+        pass
+    fragmentdir = os.path.dirname(fragmentfile)
+    os.makedirs(fragmentdir, exist_ok=True)
+    # Multiple decks can be built in parallel, and they all write their
+    # fragments to the same place; so write to a temporary file first.
+    tmp = "{}.{}.{}".format(fragmentfile, os.getpid(), threading.get_ident())
+    with open(tmp, "w") as f:
+        f.write(markdown)
+    os.replace(tmp, fragmentfile)
+
+# Add the slide footers, and the title slide placeholders.
+def finishfragment(markdown, titles, filename):
+    with profile.phase("slide footers", filename):
+        markdown = addfooters(markdown, filename)
+    with profile.phase("title insertion", filename):
+        return splittitles(markdown, titles)
+
+# Add a footer to each slide, with a link to the source file.
+def addfooters(markdown, filename):
+    slidefooter = ".debug[{}]".format(makelink(filename))
+    markdown = markdown.replace("\n---\n", "\n{}\n---\n".format(slidefooter))
+    markdown += "\n" + slidefooter
+    return markdown
+
+# Information about the git repository: the URL template used to generate
+# "edit me on GitHub"-style links, the HEAD commit, and the output of
+# "git status" (which can be slow on a big working tree).
+# It is computed lazily (only when we actually generate a deck), once per
+# build (with --all, the worker processes get it from the parent).
+# The URL template and the commit are also saved in the build cache (keyed
+# by HEAD, the refs, and the repository config) so that the next builds
+# don't have to run git again for these; but "git status" changes each
+# time a file is edited, so it always runs.
+# In CI, these can also be set with environment variables: REPOSITORY_URL,
+# BRANCH, COMMIT_REF (these three are set by Netlify), and DIRTY_FILES.
+_gitinfo = None
+
+def gitinfo():
+    global _gitinfo
+    if _gitinfo is None:
+        info = cachedgitinfo()
+        with profile.phase("git status"):
+            info["dirtyfiles"] = gitstatus()
+        _gitinfo = info
+    return _gitinfo
+
+def cachedgitinfo():
+    key = gitstate()
+    path = os.path.join(cache.directory, "git.json") if cache.directory and key else None
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if data["key"] == key:
+            logging.debug("Loaded git information from {}.".format(path))
+            return data["info"]
+    except (TypeError, OSError, ValueError, KeyError):
+        pass
+    with profile.phase("git info"):
+        info = probegit()
+    if path:
+        os.makedirs(cache.directory, exist_ok=True)
+        tmp = "{}.{}".format(path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(dict(key=key, info=info), f)
+        os.replace(tmp, path)
+    return info
+
+def findgitdir():
+    path = os.getcwd()
+    while not os.path.isdir(os.path.join(path, ".git")):
+        if os.path.dirname(path) == path:
+            return None
+        path = os.path.dirname(path)
+    return os.path.join(path, ".git")
+
+# Returns a digest that changes when HEAD moves or when the repository
+# config changes (e.g. remote.origin.url), without running git
+# (or None if we can't find the .git directory).
+def gitstate():
+    gitdir = findgitdir()
+    if not gitdir:
+        return None
+    state = [os.getcwd()] + [os.environ.get(k, "") for k in
+        ["REPOSITORY_URL", "BRANCH", "COMMIT_REF"]]
+    try:
+        head = open(os.path.join(gitdir, "HEAD")).read()
+        state.append(head)
+        if head.startswith("ref: "):
+            ref = os.path.join(gitdir, head[len("ref: "):].strip())
+            if os.path.isfile(ref):
+                state.append(open(ref).read())
+        for name in ["packed-refs", "config"]:
+            if os.path.isfile(os.path.join(gitdir, name)):
+                state.append(str(os.stat(os.path.join(gitdir, name)).st_mtime_ns))
+    except OSError:
+        return None
+    return digest("\0".join(state))
+
+def probegit():
+    logging.debug("Running git to get repository information.")
+    # Try to figure out the URL of the repo on GitHub.
+    # This is used to generate "edit me on GitHub"-style links.
+    try:
+        if "REPOSITORY_URL" in os.environ:
+            repo = os.environ["REPOSITORY_URL"]
+        else:
+            repo = subprocess.check_output(["git", "config", "remote.origin.url"]).decode("ascii")
+        repo = repo.strip().replace("git@github.com:", "https://github.com/")
+        if "BRANCH" in os.environ:
+            branch = os.environ["BRANCH"]
+        else:
+            branch = subprocess.check_output(["git", "rev-parse", "--abbrev-ref", "HEAD"]).decode("ascii")
+            branch = branch.strip()
+        base = subprocess.check_output(["git", "rev-parse", "--show-prefix"]).decode("ascii")
+        base = base.strip().strip("/")
+        urltemplate = ("{repo}/tree/{branch}/{base}/{filename}"
+            .format(repo=repo, branch=branch, base=base, filename="{}"))
+    except:
+        logging.exception("Could not generate repository URL; generating local URLs instead.")
+        urltemplate = "file://{pwd}/{filename}".format(pwd=os.environ["PWD"], filename="{}")
+    try:
+        if "COMMIT_REF" in os.environ:
+            commit = os.environ["COMMIT_REF"][:7]
+        else:
+            commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).decode("ascii")
+    except:
+        logging.exception("Could not figure out HEAD commit.")
+        commit = "??????"
+    return dict(urltemplate=urltemplate, commit=commit)
+
+def gitstatus():
+    try:
+        if "DIRTY_FILES" in os.environ:
+            dirtyfiles = os.environ["DIRTY_FILES"]
+        else:
+            dirtyfiles = subprocess.check_output(["git", "status", "--porcelain"]).decode("ascii")
+    except:
+        logging.exception("Could not figure out repository cleanliness.")
+        dirtyfiles = "?? git status --porcelain failed"
+    return dirtyfiles
 
 def makelink(filename):
     if os.path.isfile(filename):
-        url = urltemplate.format(filename)
+        url = gitinfo()["urltemplate"].format(filename)
         return "[{}]({})".format(filename, url)
     else:
         return filename
 
-if len(sys.argv) != 2:
-    logging.error("This program takes one and only one argument: the YAML file to process.")
-else:
-    filename = sys.argv[1]
+# Load a YAML manifest and fill in the defaults.
+def loadmanifest(filename):
     if filename == "-":
         filename = "<stdin>"
         manifest = sys.stdin
     else:
         manifest = open(filename)
-    logging.info("Processing {}...".format(filename))
-
-    manifest = yaml.safe_load(manifest)
+    with profile.phase("manifest load", filename):
+        manifest = yaml.safe_load(manifest)
     for k in manifest:
         override = os.environ.get("OVERRIDE_"+k)
         if override:
@@ -274,6 +874,349 @@ else:
             manifest["zip"] = manifest["slides"] + "/slides.zip"
     if "html" not in manifest:
         manifest["html"] = filename + ".html"
+    return manifest
 
-    sys.stdout.write(generatefromyaml(manifest, filename))
+# Generate the HTML for one deck, and write it to "out".
+# This resets the per-deck global state, so that multiple decks
+# can be generated (one after the other) by the same process.
+# Returns the sidecar files of the deck (see generatefromyaml).
+def builddeck(filename, out):
+    global manifest
+    logging.info("Processing {}...".format(filename))
+    manifest = loadmanifest(filename)
+    interstitials.load()
+    title2part.clear()
+    del all_titles[:]
+    # The footers need gitinfo(); get it now (if it's not already there),
+    # so that its time isn't counted in the phases of the first file.
+    gitinfo()
+    sidecars = generatefromyaml(manifest, "<stdin>" if filename == "-" else filename, out)
     logging.info("Processed {}.".format(filename))
+    return sidecars
+
+def htmlfile(filename, outdir):
+    return os.path.join(outdir, os.path.basename(filename) + ".html")
+
+# Sidecar files are saved next to the HTML file: slide statistics
+# (foo.yml.stats.json, used by count-slides.py) and the slide index
+# (foo.yml.slides.json, used by autopilot/autotest.py).
+sidecar_kinds = ["stats", "slides"]
+
+def sidecarfile(filename, outdir, kind):
+    return os.path.join(outdir, os.path.basename(filename) + ".{}.json".format(kind))
+
+def writesidecar(data, path, kind):
+    tmp = "{}.{}".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        if kind == "slides":
+            # This one has an entry for each slide; keep it compact.
+            json.dump(data, f, separators=(",", ":"))
+        else:
+            json.dump(data, f, indent=2)
+        f.write("\n")
+    os.replace(tmp, path)
+
+# Statistics about the build cache and the @@INCLUDE cache.
+def counters():
+    return collections.Counter(
+        cache_hits=cache.hits,
+        cache_misses=cache.misses,
+        include_bytes_from_cache=includes.bytes_from_cache,
+        include_bytes_from_disk=includes.bytes_from_disk,
+        )
+
+def logcounters(c):
+    if cache.directory:
+        logging.info("Cache: {} hits, {} misses.".format(c["cache_hits"], c["cache_misses"]))
+    logging.info("Includes: {} bytes from cache, {} bytes from disk.".format(
+        c["include_bytes_from_cache"], c["include_bytes_from_disk"]))
+
+# Runs in a worker process when building multiple decks.
+# Returns (filename, error, counters, profiling data).
+def renderdeck(args):
+    filename, outdir = args
+    before = counters()
+    profile.clear()
+    try:
+        with open(htmlfile(filename, outdir), "w") as f:
+            sidecars = builddeck(filename, f)
+        for kind in sidecar_kinds:
+            writesidecar(sidecars[kind], sidecarfile(filename, outdir, kind), kind)
+        error = None
+    except Exception as e:
+        logging.exception("Could not build {}.".format(filename))
+        error = str(e)
+    after = counters()
+    after.subtract(before)
+    return filename, error, after, profile.data()
+
+# Remove the output of a deck that failed to build.
+def removedeck(filename, outdir):
+    paths = [htmlfile(filename, outdir)]
+    paths += [sidecarfile(filename, outdir, kind) for kind in sidecar_kinds]
+    for path in paths:
+        if os.path.exists(path):
+            os.unlink(path)
+
+# Runs when a worker process starts, with what the parent process loaded.
+# (With the "fork" start method, the worker already has all that; with
+# "spawn" or "forkserver", it re-imports this module and starts empty.)
+def initworker(profiling, preloaded_sources, preloaded_includes, preloaded_gitinfo):
+    global _gitinfo
+    profile.enabled = profiling
+    sources.update(preloaded_sources)
+    includes.files.update(preloaded_includes)
+    _gitinfo = preloaded_gitinfo
+
+# Workers inherit the memory of the parent when they are forked, so use
+# "fork" where it's available (it's not on Windows, and it's no longer
+# the default on macOS and on recent Python versions).
+def poolcontext():
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+# Build multiple decks. Markdown files are loaded once (before starting
+# the worker processes, so that the workers share them), then decks are
+# rendered in parallel. Returns the list of decks that failed.
+def buildall(filenames, outdir, jobs):
+    for filename in filenames:
+        try:
+            for contentfile in contentfiles(loadmanifest(filename)["content"]):
+                includes.dependencies(readsource(contentfile))
+        except Exception:
+            # Don't fail all the decks; this one will fail in renderdeck.
+            logging.exception("Could not load the files of {}.".format(filename))
+    logging.info("Loaded {} markdown files for {} decks.".format(len(sources), len(filenames)))
+    # Get git information now, so that all the workers can share it.
+    gitinfo()
+    # Start with what the parent process did (e.g. loading included files).
+    total = counters()
+    failed = []
+    with poolcontext().Pool(min(jobs, len(filenames)), initializer=initworker,
+            initargs=(profile.enabled, sources, includes.files, gitinfo())) as pool:
+        for filename, error, deck_counters, deck_profile in pool.imap_unordered(
+                renderdeck, [(filename, outdir) for filename in filenames]):
+            total.update(deck_counters)
+            profile.merge(deck_profile)
+            if error:
+                failed.append(filename)
+                removedeck(filename, outdir)
+    logcounters(total)
+    return failed
+
+# Files that every deck depends on, besides the ones in its manifest.
+common_dependencies = ["workshop.html", "interstitials.txt"]
+
+# All the files that a deck depends on: its manifest, the markdown
+# files listed in the manifest, and the files that they include.
+def dependencies(filename):
+    files = [filename] + common_dependencies
+    for contentfile in contentfiles(loadmanifest(filename)["content"]):
+        files.append(contentfile)
+        files.extend(includes.dependencies(readsource(contentfile)))
+    return set(os.path.normpath(f) for f in files)
+
+# Dependency index of a bunch of decks, without rendering them.
+# "decks" maps each deck to the markdown files in its manifest (in order)
+# and to the files included by each of them; "dependents" maps each file
+# to the decks using it (directly or through @@INCLUDE), and "includedby"
+# maps each included file to the markdown files including it.
+# The "common" files are used by all decks. "errors" maps the decks whose
+# files couldn't be loaded to the corresponding error message.
+def depsindex(filenames):
+    decks = {}
+    dependents = {}
+    includedby = {}
+    errors = {}
+    for filename in filenames:
+        try:
+            files = list(contentfiles(loadmanifest(filename)["content"]))
+            for contentfile in files:
+                readsource(contentfile)
+        except Exception as e:
+            logging.exception("Could not load the files of {}.".format(filename))
+            errors[filename] = str(e)
+            continue
+        deck_includes = {}
+        for contentfile in files:
+            contentfile_includes = includes.dependencies(readsource(contentfile))
+            if contentfile_includes:
+                deck_includes[contentfile] = contentfile_includes
+            for included in contentfile_includes:
+                includedby.setdefault(included, set()).add(contentfile)
+        decks[filename] = dict(files=files, includes=deck_includes)
+        paths = set([filename] + files).union(*deck_includes.values())
+        for path in paths:
+            dependents.setdefault(os.path.normpath(path), set()).add(filename)
+    return dict(
+        common=common_dependencies,
+        decks=decks,
+        dependents={k: sorted(v) for k, v in dependents.items()},
+        includedby={k: sorted(v) for k, v in includedby.items()},
+        errors=errors,
+        )
+
+# Wait for changes by checking the modification time of the files.
+# Used when inotify is not available.
+class PollingWatcher(object):
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.mtimes = {}
+
+    def mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def wait(self, paths):
+        for path in paths:
+            if path not in self.mtimes:
+                self.mtimes[path] = self.mtime(path)
+        while True:
+            changed = set()
+            for path in paths:
+                mtime = self.mtime(path)
+                if mtime != self.mtimes[path]:
+                    self.mtimes[path] = mtime
+                    changed.add(path)
+            if changed:
+                return changed
+            time.sleep(self.interval)
+
+# Wait for changes with inotify. We watch directories rather than
+# files, because many editors save files by renaming a new file
+# over the old one.
+class InotifyWatcher(object):
+
+    def __init__(self, inotify_simple):
+        self.flags = inotify_simple.flags
+        self.inotify = inotify_simple.INotify()
+        self.directories = {}
+
+    def wait(self, paths):
+        for directory in set(os.path.dirname(path) or "." for path in paths):
+            if directory not in self.directories.values():
+                wd = self.inotify.add_watch(directory,
+                    self.flags.CLOSE_WRITE | self.flags.MOVED_TO |
+                    self.flags.CREATE | self.flags.DELETE)
+                self.directories[wd] = directory
+        while True:
+            changed = set()
+            # Wait a little bit after the first event, to get all the
+            # events of e.g. a "git checkout" in a single batch.
+            for event in self.inotify.read(read_delay=100):
+                if event.wd in self.directories:
+                    changed.add(os.path.normpath(
+                        os.path.join(self.directories[event.wd], event.name)))
+            changed &= paths
+            if changed:
+                return changed
+
+def makewatcher():
+    try:
+        import inotify_simple
+    except ImportError:
+        logging.info("Python module inotify_simple not found; polling for changes instead.")
+        return PollingWatcher()
+    return InotifyWatcher(inotify_simple)
+
+# Watch the files used by the decks, and rebuild decks when these
+# files change. Markdown files are kept in memory, and only the decks
+# depending on a changed file get rebuilt.
+def watch(filenames, outdir):
+    deps = {}
+    for filename in filenames:
+        try:
+            deps[filename] = dependencies(filename)
+        except Exception:
+            logging.exception("Could not compute dependencies of {}.".format(filename))
+            deps[filename] = set([os.path.normpath(filename)])
+    watcher = makewatcher()
+    logging.info("Watching {} files for {} decks.".format(
+        len(set().union(*deps.values())), len(filenames)))
+    while True:
+        changed = watcher.wait(set().union(*deps.values()))
+        start = time.time()
+        logging.info("Changed: {}".format(" ".join(sorted(changed))))
+        for path in changed:
+            sources.pop(path, None)
+        # Check git again (HEAD may have moved, and "git status" changed).
+        global _gitinfo
+        _gitinfo = None
+        affected = [filename for filename in filenames if deps[filename] & changed]
+        for filename in affected:
+            filename, error, deck_counters, deck_profile = renderdeck((filename, outdir))
+            if error:
+                removedeck(filename, outdir)
+            try:
+                deps[filename] = dependencies(filename)
+            except Exception:
+                logging.exception("Could not compute dependencies of {}.".format(filename))
+        logging.info("Rebuilt {} deck(s) in {:.3f}s: {}".format(
+            len(affected), time.time() - start, " ".join(affected)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Transform YAML manifests into HTML workshop files.")
+    parser.add_argument("manifests", metavar="YAML", nargs="+",
+        help="YAML manifest to process (\"-\" for stdin)")
+    parser.add_argument("--all", action="store_true",
+        help="build all the manifests given on the command line, "
+             "writing each one to OUTDIR/<manifest>.html")
+    parser.add_argument("--watch", action="store_true",
+        help="watch the manifests given on the command line (and the files "
+             "they use), and rebuild decks as needed into OUTDIR/<manifest>.html")
+    parser.add_argument("--deps", action="store_true",
+        help="don't build anything; show (as JSON) which files are used "
+             "by the manifests given on the command line, and vice versa")
+    parser.add_argument("--outdir", default=".",
+        help="where to write HTML files with --all and --watch (default: %(default)s)")
+    parser.add_argument("--profile", metavar="FILE",
+        help="record how long each phase of the build takes (and how long "
+             "is spent on each file); save that to FILE (as JSON) "
+             "and show a summary on stderr")
+    parser.add_argument("--stats", metavar="FILE",
+        help="when building a single deck (to stdout), save slide statistics "
+             "to FILE (as JSON); with --all and --watch, they are always saved "
+             "to OUTDIR/<manifest>.stats.json")
+    parser.add_argument("--slides", metavar="FILE",
+        help="when building a single deck (to stdout), save the slide index "
+             "used by autopilot/autotest.py to FILE (as JSON); with --all and "
+             "--watch, it is always saved to OUTDIR/<manifest>.slides.json "
+             "(autotest.py expects foo.slides.json next to foo.html)")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(),
+        help="how many decks to build in parallel with --all (default: %(default)s)")
+    args = parser.parse_args()
+    profile.enabled = bool(args.profile)
+
+    failed = []
+    if args.deps:
+        index = depsindex(args.manifests)
+        json.dump(index, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+        failed = sorted(index["errors"])
+    elif args.watch:
+        try:
+            watch(args.manifests, args.outdir)
+        except KeyboardInterrupt:
+            pass
+    elif args.all:
+        failed = buildall(args.manifests, args.outdir, args.jobs)
+        if failed:
+            logging.error("Failed to build: {}".format(" ".join(failed)))
+    elif len(args.manifests) != 1:
+        logging.error("This program takes one and only one argument: the YAML file to process.")
+    else:
+        sidecars = builddeck(args.manifests[0], sys.stdout)
+        for kind in sidecar_kinds:
+            if getattr(args, kind):
+                writesidecar(sidecars[kind], getattr(args, kind), kind)
+        logcounters(counters())
+
+    if args.profile:
+        profile.report(args.profile)
+    if failed:
+        sys.exit(1)
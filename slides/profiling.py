@@ -0,0 +1,66 @@
+# Minimal profiler for the slides build scripts (markmaker.py, index.py).
+# It accumulates the time spent in each phase of the build (and, optionally,
+# on each file), and reports it as JSON and as a human-readable table.
+# When it's not enabled, profile.phase() costs almost nothing.
+# Phases can run in multiple threads; then their times add up.
+# Phases shouldn't be nested: the time of the inner phase would be counted
+# twice (in both phases, and for both files).
+
+import contextlib
+import json
+import sys
+import threading
+import time
+
+
+class Profile(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.phases = {}
+        self.files = {}
+
+    # Use as: "with profile.phase("foo", filename): ..."
+    @contextlib.contextmanager
+    def phase(self, name, filename=None):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+                if filename:
+                    self.files[filename] = self.files.get(filename, 0) + elapsed
+
+    def data(self):
+        return dict(phases=self.phases, files=self.files)
+
+    # Add data coming from another Profile (e.g. from a worker process).
+    def merge(self, data):
+        for name, elapsed in data["phases"].items():
+            self.phases[name] = self.phases.get(name, 0) + elapsed
+        for filename, elapsed in data["files"].items():
+            self.files[filename] = self.files.get(filename, 0) + elapsed
+
+    def report(self, path, top=10, out=sys.stderr):
+        with open(path, "w") as f:
+            json.dump(self.data(), f, indent=2, sort_keys=True)
+        width = max([len(k) for k in list(self.phases) + list(self.files)] + [20])
+        out.write("{:<{}}  {:>9}\n".format("phase", width, "seconds"))
+        for name, elapsed in self.phases.items():
+            out.write("{:<{}}  {:>9.4f}\n".format(name, width, elapsed))
+        if self.files:
+            out.write("\n{:<{}}  {:>9}\n".format("top {} files".format(top), width, "seconds"))
+            for filename in sorted(self.files, key=self.files.get, reverse=True)[:top]:
+                out.write("{:<{}}  {:>9.4f}\n".format(filename, width, self.files[filename]))
+
+
+profile = Profile()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Creates (or updates) slides.zip with the content of the slides directory.
+# Entries of the existing archive are copied as-is (without decompressing
+# and recompressing them) when the corresponding file didn't change.
+# Files that are already compressed (images...) are stored, not deflated.
+
+import copy
+import logging
+import os
+import struct
+import sys
+import time
+import zipfile
+import zlib
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
+ARCHIVE = "slides.zip"
+
+# Build intermediates and caches that don't belong in the archive.
+EXCLUDE_DIRS = ["fragments", ".markmaker-cache", "__pycache__"]
+EXCLUDE_FILES = [ARCHIVE, ARCHIVE + ".tmp"]
+# Sidecar files generated by markmaker.py next to each deck.
+EXCLUDE_SUFFIXES = [".stats.json", ".slides.json"]
+
+STORED_EXTENSIONS = [".png", ".jpg", ".jpeg", ".gif", ".webp", ".zip", ".gz"]
+
+
+def walk(top):
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames[:] = sorted(d for d in dirnames if d not in EXCLUDE_DIRS)
+        for filename in sorted(filenames):
+            path = os.path.relpath(os.path.join(dirpath, filename), top)
+            if path in EXCLUDE_FILES or path.endswith(tuple(EXCLUDE_SUFFIXES)):
+                continue
+            yield path
+
+
+def crc32(path):
+    crc = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+# Check if an entry of the old archive can be reused for a file.
+# We compare size and modification time first; if the modification
+# time is different (e.g. after a git checkout) we compare the CRC.
+# Zip timestamps have a resolution of 2 seconds (odd seconds are
+# rounded down), so that's our tolerance.
+def unchanged(info, path, stat):
+    if info.file_size != stat.st_size:
+        return False
+    if info.flag_bits & 0x08:
+        # Entries with a data descriptor are harder to copy; don't bother.
+        return False
+    if 0 <= stat.st_mtime - time.mktime(info.date_time + (0, 0, -1)) < 2:
+        return True
+    return info.CRC == crc32(path)
+
+
+# The zipfile module doesn't have an API to add an entry without
+# recompressing it, so copyentry writes to the underlying file and
+# updates these private attributes of ZipFile (as ZipFile.write does).
+# They have been there for a long time, but they might change in
+# future Python versions; if they're missing, we recompress entries.
+ZIPFILE_INTERNALS = ["fp", "start_dir", "filelist", "NameToInfo", "_didModify"]
+
+
+def cancopy(old, new):
+    return hasattr(old, "fp") and all(hasattr(new, a) for a in ZIPFILE_INTERNALS)
+
+
+# Copy the local header and compressed data of an entry, as-is
+# (except for the modification time, which is set to date_time, so that
+# the next run doesn't have to check the CRC again).
+def copyentry(old, new, info, date_time):
+    old.fp.seek(info.header_offset)
+    header = old.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    data = old.fp.read(name_length + extra_length + info.compress_size)
+    year, month, day, hour, minute, second = date_time
+    header = header[:10] + struct.pack(
+        "<HH", hour << 11 | minute << 5 | second // 2,
+        (year - 1980) << 9 | month << 5 | day) + header[14:]
+    newinfo = copy.copy(info)
+    newinfo.date_time = date_time
+    newinfo.header_offset = new.fp.tell()
+    new.fp.write(header + data)
+    new.start_dir = new.fp.tell()
+    new.filelist.append(newinfo)
+    new.NameToInfo[newinfo.filename] = newinfo
+    new._didModify = True
+
+
+def main(top="."):
+    archive = os.path.normpath(os.path.join(top, ARCHIVE))
+    old = None
+    if os.path.exists(archive):
+        try:
+            old = zipfile.ZipFile(archive)
+        except zipfile.BadZipFile:
+            logging.warning("Could not open existing {}; creating it from scratch.".format(archive))
+    reused = deflated = stored = 0
+    with zipfile.ZipFile(archive + ".tmp", "w", zipfile.ZIP_DEFLATED) as new:
+        if old and not cancopy(old, new):
+            logging.warning("This version of the zipfile module isn't supported; "
+                            "all the files will be compressed again.")
+            old.close()
+            old = None
+        for path in walk(top):
+            fullpath = os.path.join(top, path)
+            stat = os.stat(fullpath)
+            info = old.NameToInfo.get(path) if old else None
+            if info and unchanged(info, fullpath, stat):
+                copyentry(old, new, info, time.localtime(stat.st_mtime)[:6])
+                reused += 1
+            elif os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+                new.write(fullpath, path, zipfile.ZIP_STORED)
+                stored += 1
+            else:
+                new.write(fullpath, path)
+                deflated += 1
+    if old:
+        old.close()
+    os.replace(archive + ".tmp", archive)
+    logging.info("Created {} archive ({} files reused, {} deflated, {} stored)."
+                 .format(archive, reused, deflated, stored))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])